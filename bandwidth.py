@@ -0,0 +1,127 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Bytes per second in one megabit per second (budgets in config.json are in Mbit/s)
+MBIT = 1000 * 1000 / 8
+
+
+class TokenBucket:
+    """
+    Бюджет скорости `rate` байт/с с запасом `burst` байт (по умолчанию — секунда).
+
+    reserve(n) списывает n байт и возвращает, сколько секунд потребителю нужно
+    подождать: долг копится общий, поэтому все, кто тратит бюджет, вместе не
+    превышают `rate`. Состояние можно держать в multiprocessing.Array('d', 2)
+    (см. shared()), тогда бюджет общий и для процессов-воркеров.
+    """
+
+    def __init__(self, rate, burst=None, state=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        if state is None:
+            self._state = [self.burst, time.monotonic()]
+            self._lock = threading.Lock()
+        else:
+            self._state = state
+            self._lock = state.get_lock()
+        self.waited = 0.0
+
+    def shared(self, ctx):
+        """Копия с состоянием в общей памяти — передаётся процессам контекста `ctx` при запуске."""
+        return TokenBucket(self.rate, self.burst, ctx.Array('d', [self.burst, time.monotonic()]))
+
+    def reserve(self, n):
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate) - n
+            self._state[0], self._state[1] = tokens, now
+            wait = -tokens / self.rate if tokens < 0 else 0.0
+            # per process: workers sharing the state keep their own count
+            self.waited += wait
+        return wait
+
+
+def throttle_hook(bucket):
+    """
+    Хук прогресса yt-dlp, который списывает скачанные байты из `bucket` и при
+    превышении бюджета усыпляет поток загрузки (или поток фрагмента).
+    """
+    seen = {}
+    lock = threading.Lock()
+
+    def hook(d):
+        if d.get('status') != 'downloading':
+            return
+        name = d.get('filename')
+        cur = d.get('downloaded_bytes') or 0
+        with lock:
+            # the first event only sets the baseline: a resumed .part is not charged again
+            prev = seen.setdefault(name, cur)
+            seen[name] = max(prev, cur)
+        if cur > prev:
+            wait = bucket.reserve(cur - prev)
+            if wait > 0:
+                time.sleep(wait)
+    return hook
+
+
+class BandwidthManager:
+    """
+    Общая полоса для всех задач: параллельные фрагменты загрузок и бюджеты
+    скачивания и отправки.
+
+    Каждая загрузка получает concurrent_fragment_downloads из общего запаса
+    `fragment_threads`: пока задача одна, она качает до `max_fragments`
+    фрагментов сразу, при нагрузке доля каждой новой задачи уменьшается до
+    одного потока. Бюджеты в байтах/с (0 — без ограничения) делятся между
+    всеми задачами через TokenBucket: скачивание тормозится хуком прогресса
+    yt-dlp (throttle_hook), отправка — колбэком прогресса pyrogram.
+    """
+
+    def __init__(self, download_rate=0, upload_rate=0, fragment_threads=16, max_fragments=8):
+        self.fragment_threads = max(int(fragment_threads), 1)
+        self.max_fragments = max(int(max_fragments), 1)
+        self.download_bucket = TokenBucket(download_rate) if download_rate else None
+        self.upload_bucket = TokenBucket(upload_rate) if upload_rate else None
+        self._lock = threading.Lock()
+        self.active = 0
+        self.allocated = 0
+
+    @contextmanager
+    def download(self):
+        """Слот загрузки: отдаёт число параллельных фрагментов с учётом текущей нагрузки."""
+        with self._lock:
+            self.active += 1
+            fair = self.fragment_threads // self.active
+            free = self.fragment_threads - self.allocated
+            fragments = max(1, min(self.max_fragments, fair, free))
+            self.allocated += fragments
+        try:
+            yield fragments
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.allocated -= fragments
+
+    async def upload(self, n):
+        """Списать `n` отправленных байт; ждёт, если бюджет отправки исчерпан."""
+        if self.upload_bucket is None or n <= 0:
+            return
+        wait = self.upload_bucket.reserve(n)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def upload_throttle(self):
+        """Колбэк прогресса pyrogram, который держит отправку в рамках бюджета."""
+        sent = [None]
+
+        async def throttle(cur, tot):
+            # the first call is the baseline: Uploader reports parts already on the server before resuming
+            n, sent[0] = cur - (cur if sent[0] is None else sent[0]), cur
+            await self.upload(n)
+        return throttle
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Playlist pages: YouTube / YouTube Music playlists, Yandex Music albums and user playlists
+PLAYLIST_RE = re.compile(
+    r"https?://(?:(?:www|m|music)\.)?youtube\.com/playlist\?"
+    r"|https?://music\.yandex\.(?:ru|com|by|kz)/album/\d+/?(?:[?#]|$)"
+    r"|https?://music\.yandex\.(?:ru|com|by|kz)/users/[^/\s]+/playlists/\d+"
+)
+
+_END = object()
+
+
+async def lazy_entries(entries, limit=None, skip=0):
+    """
+    Асинхронно перебрать (возможно ленивый) список записей плейлиста yt-dlp.
+    Следующая страница запрашивается в пуле потоков только когда до неё дошла очередь.
+    Первые `skip` записей (уже обработанные до перезапуска) пропускаются, но входят в `limit`.
+    """
+    loop = asyncio.get_running_loop()
+    it = iter(entries or ())
+    count = 0
+    while limit is None or count < limit:
+        entry = await loop.run_in_executor(None, next, it, _END)
+        if entry is _END:
+            return
+        if not entry:
+            continue
+        count += 1
+        if count > skip:
+            yield entry
+
+
+class BatchItem:
+    # media_id / job / file_id / hold are filled in by the stages of the caller
+    __slots__ = ('index', 'url', 'title', 'entry', 'state', 'error', 'media_id', 'job', 'file_id', 'hold')
+
+    def __init__(self, index, url, title, entry):
+        self.index = index
+        self.url = url
+        self.title = title
+        self.entry = entry
+        self.state = 'queued'
+        self.error = None
+        self.media_id = None
+        self.job = None
+        self.file_id = None
+        self.hold = None
+
+    @classmethod
+    def from_entry(cls, index, entry):
+        """Элемент из плоской записи плейлиста yt-dlp (extract_flat)."""
+        url = entry.get('url') or entry.get('webpage_url') or entry.get('id')
+        return cls(index, url, entry.get('title') or url, entry)
+
+
+class BatchPipeline:
+    """
+    Конвейер пакетной обработки плейлиста.
+
+    Записи плейлиста берутся из асинхронного итератора по мере освобождения окна `prefetch`:
+    пока текущий элемент отправляется, следующие уже скачиваются и перекодируются.
+    Отправка идёт строго в порядке плейлиста. Ошибка одного элемента записывается
+    в него и не останавливает остальные.
+
+    fetch(item) -> payload, deliver(item, payload), release(item, payload) — корутины
+    этапов; on_change(pipeline) вызывается при каждой смене состояния элемента.
+    release вызывается для каждого полученного payload (и при отмене конвейера);
+    если fetch упал, освобождать захваченное он должен сам.
+    `offset` — сколько элементов плейлиста уже обработано раньше (нумерация продолжается).
+    """
+
+    def __init__(self, entries, fetch, deliver, release=None, prefetch=3, on_change=None, offset=0):
+        self.entries = entries
+        self.fetch = fetch
+        self.deliver = deliver
+        self.release = release
+        self.prefetch = max(int(prefetch), 1)
+        self.on_change = on_change
+        self.offset = offset
+        self.items = []
+        self.exhausted = False
+        self.extract_error = None
+
+    def count(self, state):
+        return sum(1 for item in self.items if item.state == state)
+
+    def processed(self):
+        """Сколько элементов с начала плейлиста уже закончено (отправлены или с ошибкой)."""
+        return self.offset + self.count('done') + self.count('failed')
+
+    def _set(self, item, state, error=None):
+        item.state = state
+        if error is not None:
+            item.error = error
+        if self.on_change:
+            try:
+                self.on_change(self)
+            except Exception as e:
+                logger.debug(f"Batch progress callback failed: {e}")
+
+    async def _fetch(self, item):
+        self._set(item, 'download')
+        return await self.fetch(item)
+
+    async def _produce(self, window, order):
+        try:
+            async for entry in self.entries:
+                await window.acquire()
+                item = BatchItem.from_entry(self.offset + len(self.items) + 1, entry)
+                self.items.append(item)
+                await order.put((item, asyncio.create_task(self._fetch(item))))
+        except Exception as e:
+            # the list is cut short, already queued items are still delivered
+            logger.error(f"Playlist extraction stopped: {e}")
+            self.extract_error = str(e)
+        finally:
+            self.exhausted = True
+            await order.put(None)
+
+    async def run(self):
+        window = asyncio.Semaphore(self.prefetch)
+        order = asyncio.Queue()
+        producer = asyncio.create_task(self._produce(window, order))
+        try:
+            while True:
+                entry = await order.get()
+                if entry is None:
+                    break
+                item, task = entry
+                try:
+                    payload = await task
+                except Exception as e:
+                    logger.warning(f"Batch item {item.index} ({item.url}) failed: {e}")
+                    self._set(item, 'failed', str(e))
+                    window.release()
+                    continue
+                try:
+                    self._set(item, 'upload')
+                    await self.deliver(item, payload)
+                    self._set(item, 'done')
+                except Exception as e:
+                    logger.warning(f"Batch item {item.index} ({item.url}) delivery failed: {e}")
+                    self._set(item, 'failed', str(e))
+                finally:
+                    if self.release:
+                        await self.release(item, payload)
+                    window.release()
+            await producer
+        finally:
+            # cancelled midway: stop extraction and the downloads already running ahead
+            producer.cancel()
+            while not order.empty():
+                entry = order.get_nowait()
+                if entry is None:
+                    continue
+                item, task = entry
+                task.cancel()
+                # already fetched but never delivered: its payload still has to be released
+                if self.release and task.done() and not task.cancelled() and task.exception() is None:
+                    await self.release(item, task.result())
+        return self.items
@@ -0,0 +1,487 @@
+"""
+Офлайн-бенчмарк горячих путей бота без Telegram и YouTube.
+
+Копирует модули бота во временную папку, подменяет yt_dlp.YoutubeDL на
+фейковый экстрактор с настраиваемыми задержками (а без `--media` и конвертацию
+ffmpeg на копирование файла) и гоняет handle_youtube_link,
+handle_music_link и cb_handler с фейковыми Message/CallbackQuery от N
+одновременных пользователей. Результаты пишутся в bench_results/ вместе с
+хешем коммита, `--compare` показывает разницу с предыдущим прогоном.
+
+    python bench.py --users 50 --unique 10
+    python bench.py --compare bench_results/<старый>.json
+"""
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, "bench_results")
+
+_ids = itertools.count(1000)
+
+
+# --- fake yt-dlp -----------------------------------------------------------
+
+class FakeYoutubeDL:
+    """Подмена yt_dlp.YoutubeDL: синтетический info dict и локальные файлы вместо сети."""
+
+    extract_latency = 0.3
+    download_latency = 1.0
+    media_size = 5 * 1024 * 1024
+    media_source = None
+    extract_calls = 0
+    download_calls = 0
+
+    def __init__(self, opts=None):
+        self.params = dict(opts or {})
+        self._pps = {'pre_process': [], 'post_process': []}
+
+    # the parts of the YoutubeDL API that ydl_pool uses to reconfigure an instance
+    def _parse_outtmpl(self):
+        pass
+
+    def build_format_selector(self, spec):
+        return spec
+
+    def add_progress_hook(self, hook):
+        pass
+
+    add_postprocessor_hook = add_post_hook = add_progress_hook
+
+    def add_post_processor(self, pp, when='post_process'):
+        self._pps[when].append(pp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _video_id(url):
+        tail = url.rstrip('/').split('=')[-1].split('/')[-1]
+        return tail[:11] or 'fakevideo00'
+
+    def extract_info(self, url, download=False, **kwargs):
+        type(self).extract_calls += 1
+        time.sleep(self.extract_latency)
+        vid = self._video_id(url)
+        duration = 240
+        formats = [{
+            'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus',
+            'tbr': 160, 'filesize': 160 * 125 * duration,
+        }]
+        for itag, height, tbr in (('160', 144, 100), ('133', 240, 250), ('134', 360, 600),
+                                  ('135', 480, 1100), ('136', 720, 2500), ('137', 1080, 4500)):
+            formats.append({
+                'format_id': itag, 'ext': 'mp4', 'vcodec': 'avc1.4d401e', 'acodec': 'none',
+                'height': height, 'tbr': tbr, 'filesize': tbr * 125 * duration,
+            })
+        formats.append({
+            'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2',
+            'height': 360, 'tbr': 700, 'filesize_approx': 700 * 125 * duration,
+        })
+        return {
+            'id': vid,
+            'title': f"Bench video {vid}",
+            'uploader': 'Bench',
+            'artist': 'Bench Artist',
+            'duration': duration,
+            'thumbnail': None,
+            'webpage_url': url,
+            'formats': formats,
+        }
+
+    def _output_path(self, url):
+        tmpl = self.params.get('outtmpl') or '%(id)s.%(ext)s'
+        if isinstance(tmpl, dict):
+            tmpl = tmpl.get('default')
+        ext = self.params.get('merge_output_format') or 'mp4'
+        for pp in self.params.get('postprocessors') or []:
+            if pp.get('key') == 'FFmpegExtractAudio':
+                ext = pp.get('preferredcodec') or 'opus'
+        path = tmpl % {'ext': ext, 'id': self._video_id(url), 'title': self._video_id(url)}
+        home = (self.params.get('paths') or {}).get('home')
+        return os.path.join(home, path) if home else path
+
+    def download(self, urls):
+        type(self).download_calls += 1
+        for url in urls:
+            total = self.media_size
+            steps = 10
+            for i in range(steps + 1):
+                d = {
+                    'status': 'downloading' if i < steps else 'finished',
+                    'downloaded_bytes': total * i // steps,
+                    'total_bytes': total,
+                }
+                for hook in self.params.get('progress_hooks') or []:
+                    hook(d)
+                if i < steps:
+                    time.sleep(self.download_latency / steps)
+            path = self._output_path(url)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            if self.media_source:
+                shutil.copyfile(self.media_source, path)
+            else:
+                with open(path, 'wb') as f:
+                    f.truncate(total)
+        return 0
+
+
+class FakeConvert:
+    """Подмена Transcoder.convert: пустышку FakeYoutubeDL ffmpeg не примет, поэтому дорожка просто копируется."""
+
+    latency = 0.2
+    calls = 0
+
+    def __init__(self, transcoder):
+        self.transcoder = transcoder
+
+    async def __call__(self, source, codec, target, fmt):
+        type(self).calls += 1
+        codec = codec or os.path.splitext(source)[1].lstrip('.')
+        mode = 'copy' if codec == fmt else 'encode'
+        await asyncio.sleep(self.latency)
+        shutil.copyfile(source, target)
+        if mode == 'copy':
+            self.transcoder.copied += 1
+        else:
+            self.transcoder.encoded += 1
+        return mode
+
+
+# --- fake pyrogram objects -------------------------------------------------
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeMedia:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeMessage:
+    upload_latency = 0.5
+    edits = 0
+    sent_files = 0
+
+    def __init__(self, chat_id, user_id, text=None):
+        self.id = next(_ids)
+        self.chat = FakeChat(chat_id)
+        self.from_user = FakeUser(user_id)
+        self.text = text
+        self.video = None
+        self.audio = None
+
+    def _reply(self, text=None):
+        return FakeMessage(self.chat.id, self.from_user.id, text)
+
+    async def reply_text(self, text, **kwargs):
+        return self._reply(text)
+
+    async def reply_photo(self, photo, caption=None, **kwargs):
+        return self._reply(caption)
+
+    async def edit_text(self, text, **kwargs):
+        type(self).edits += 1
+        self.text = text
+        return self
+
+    async def edit_reply_markup(self, reply_markup=None):
+        return self
+
+    async def delete(self):
+        return True
+
+    async def _upload(self, media, progress):
+        size = os.path.getsize(media) if os.path.isfile(media) else 0
+        if size:
+            steps = 5
+            for i in range(1, steps + 1):
+                await asyncio.sleep(self.upload_latency / steps)
+                if progress:
+                    # like pyrogram: coroutine callbacks are awaited (the bot's are, they throttle uploads)
+                    if asyncio.iscoroutinefunction(progress):
+                        await progress(size * i // steps, size)
+                    else:
+                        progress(size * i // steps, size)
+        type(self).sent_files += 1
+        return f"file-{os.path.basename(media)}" if size else media
+
+    async def reply_video(self, video, progress=None, **kwargs):
+        msg = self._reply()
+        msg.video = FakeMedia(await self._upload(video, progress))
+        return msg
+
+    async def reply_audio(self, audio, progress=None, **kwargs):
+        msg = self._reply()
+        msg.audio = FakeMedia(await self._upload(audio, progress))
+        return msg
+
+    async def reply_document(self, document, progress=None, **kwargs):
+        msg = self._reply()
+        msg.document = FakeMedia(await self._upload(document, progress))
+        return msg
+
+
+class FakeCallbackQuery:
+    def __init__(self, user_id, message, data):
+        self.from_user = FakeUser(user_id)
+        self.message = message
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+
+# --- harness ---------------------------------------------------------------
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pct(p):
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))], 4)
+    return {
+        'count': len(values),
+        'mean': round(statistics.fmean(values), 4),
+        'p50': pct(50), 'p90': pct(90), 'p99': pct(99),
+        'max': round(values[-1], 4),
+    }
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_bot(sandbox, overrides):
+    """Скопировать модули бота в `sandbox` с тестовым config.json и импортировать main."""
+    for path in glob.glob(os.path.join(BASE_DIR, '*.py')):
+        shutil.copy(path, sandbox)
+    with open(os.path.join(BASE_DIR, 'config.json'), 'r', encoding='utf-8') as f:
+        cfg = json.load(f)
+    cfg.update(overrides)
+    with open(os.path.join(sandbox, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(cfg, f)
+    os.environ.setdefault('API_ID', '1')
+    os.environ.setdefault('API_HASH', 'bench')
+    os.environ.setdefault('BOT_TOKEN', '1:bench')
+
+    import yt_dlp
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    sys.path.insert(0, sandbox)
+    import main
+    return main
+
+
+async def simulate_user(bot, n, args, lat):
+    user_id = 10_000 + n
+    vid = f"bench{n % args.unique:06d}"
+    # spread music links evenly: music_share percent of users
+    music = (n * args.music_share // 100) != ((n + 1) * args.music_share // 100)
+    if music:
+        url = f"https://music.youtube.com/watch?v={vid}"
+        handler, data = bot.handle_music_link, f"audioformat:{args.audio_format}"
+    else:
+        url = f"https://www.youtube.com/watch?v={vid}"
+        handler, data = bot.handle_youtube_link, f"video:{args.resolution}"
+
+    msg = FakeMessage(user_id, user_id, url)
+    replies = []
+    orig_photo, orig_text = msg.reply_photo, msg.reply_text
+
+    async def capture_photo(*a, **kw):
+        reply = await orig_photo(*a, **kw)
+        replies.append(reply)
+        return reply
+
+    async def capture_text(*a, **kw):
+        reply = await orig_text(*a, **kw)
+        replies.append(reply)
+        return reply
+    msg.reply_photo, msg.reply_text = capture_photo, capture_text
+
+    started = time.perf_counter()
+    await handler(None, msg)
+    lat['link'].append(time.perf_counter() - started)
+    if not replies:
+        return False
+
+    cq = FakeCallbackQuery(user_id, replies[-1], data)
+    started = time.perf_counter()
+    await bot.cb_handler(None, cq)
+    lat['callback'].append(time.perf_counter() - started)
+    return True
+
+
+def bench_stores(bot, ops):
+    """Стоимость операций хранилища сессий и реестра пользователей (мкс на операцию)."""
+    sessions, users = bot.sessions, bot.users
+    payload = {'url': 'https://youtu.be/x', 'manifest': {'id': 'x', 'formats': [[str(i)] * 7 for i in range(20)]}}
+    result = {}
+    started = time.perf_counter()
+    for i in range(ops):
+        sessions.put(f"bench:{i}", payload)
+    result['session_put_us'] = (time.perf_counter() - started) / ops * 1e6
+    started = time.perf_counter()
+    for i in range(ops):
+        sessions.get(f"bench:{i}")
+    result['session_get_us'] = (time.perf_counter() - started) / ops * 1e6
+    started = time.perf_counter()
+    for i in range(ops):
+        sessions.delete(f"bench:{i}")
+    result['session_delete_us'] = (time.perf_counter() - started) / ops * 1e6
+    started = time.perf_counter()
+    for i in range(ops):
+        bot.track_user(5_000_000 + i)
+    users.flush()
+    result['track_user_us'] = (time.perf_counter() - started) / ops * 1e6
+    started = time.perf_counter()
+    for i in range(ops):
+        bot.track_user(5_000_000 + i)
+    result['track_known_user_us'] = (time.perf_counter() - started) / ops * 1e6
+    return {k: round(v, 2) for k, v in result.items()}
+
+
+async def run(args):
+    FakeYoutubeDL.extract_latency = args.extract_latency
+    FakeYoutubeDL.download_latency = args.download_latency
+    FakeYoutubeDL.media_size = int(args.size_mb * 1024 * 1024)
+    FakeYoutubeDL.media_source = args.media
+    FakeMessage.upload_latency = args.upload_latency
+    FakeConvert.latency = args.transcode_latency
+
+    sandbox = tempfile.mkdtemp(prefix='quix_bench_')
+    try:
+        bot = load_bot(sandbox, {
+            'max_jobs': args.max_jobs,
+            'max_jobs_per_user': args.max_jobs_per_user,
+            'worker_mode': 'thread',
+            'metrics_port': 0,
+            'metrics_file': '',
+        })
+        if args.media is None:
+            bot.transcoder.convert = FakeConvert(bot.transcoder)
+        import logging
+        logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+        lat = {'link': [], 'callback': []}
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(simulate_user(bot, n, args, lat) for n in range(args.users)),
+            return_exceptions=True
+        )
+        wall = time.perf_counter() - started
+        errors = [repr(r) for r in results if isinstance(r, BaseException)]
+        jobs = sum(1 for r in results if r is True)
+        # handlers report their own failures to the user, so errors only has harness crashes
+        statuses = {}
+        for key, value in bot.metrics._counters.get('jobs_total', {}).items():
+            status = dict(key)['status']
+            statuses[status] = statuses.get(status, 0) + int(value)
+
+        report = {
+            'rev': _git_rev(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': vars(args),
+            'wall_seconds': round(wall, 3),
+            'jobs': jobs,
+            'jobs_per_second': round(jobs / wall, 3) if wall else 0,
+            'errors': errors[:10],
+            'job_status': statuses,
+            'failed_jobs': sum(n for status, n in statuses.items() if status != 'ok'),
+            'latency': {k: _percentiles(v) for k, v in lat.items()},
+            'extract_calls': FakeYoutubeDL.extract_calls,
+            'download_calls': FakeYoutubeDL.download_calls,
+            'transcodes': bot.transcoder.encoded + bot.transcoder.copied,
+            'uploads': FakeMessage.sent_files,
+            'status_edits': FakeMessage.edits,
+            'stores': bench_stores(bot, args.store_ops),
+        }
+        return report
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+
+def compare(report, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        base = json.load(f)
+    print(f"\nCompared with {base.get('rev')} ({baseline_path}):")
+    rows = [('jobs_per_second', report['jobs_per_second'], base.get('jobs_per_second'))]
+    for handler in ('link', 'callback'):
+        for p in ('p50', 'p90', 'p99'):
+            rows.append((f"{handler}.{p}", report['latency'].get(handler, {}).get(p),
+                         base.get('latency', {}).get(handler, {}).get(p)))
+    for key, value in report['stores'].items():
+        rows.append((key, value, base.get('stores', {}).get(key)))
+    for name, new, old in rows:
+        if new is None or not old:
+            print(f"  {name:24} {new}")
+            continue
+        print(f"  {name:24} {old:>10} -> {new:<10} ({(new - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20, help="одновременных пользователей")
+    parser.add_argument('--unique', type=int, default=None, help="различных роликов (по умолчанию = users)")
+    parser.add_argument('--music-share', type=int, default=30, help="процент пользователей с музыкальными ссылками")
+    parser.add_argument('--resolution', type=int, default=720)
+    parser.add_argument('--audio-format', default='mp3')
+    parser.add_argument('--extract-latency', type=float, default=0.3)
+    parser.add_argument('--download-latency', type=float, default=1.0)
+    parser.add_argument('--upload-latency', type=float, default=0.5)
+    parser.add_argument('--transcode-latency', type=float, default=0.2, help="задержка подменённой конвертации (без --media)")
+    parser.add_argument('--size-mb', type=float, default=5)
+    parser.add_argument('--media', default=None, help="локальный файл, который «скачивается» вместо пустышки")
+    parser.add_argument('--max-jobs', type=int, default=4)
+    parser.add_argument('--max-jobs-per-user', type=int, default=1)
+    parser.add_argument('--store-ops', type=int, default=2000)
+    parser.add_argument('--compare', default=None, help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    if args.unique is None:
+        args.unique = args.users
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.compare:
+        compare(report, args.compare)
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{report['rev']}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nSaved to {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import io
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+NETSCAPE_HEADER = "# Netscape HTTP Cookie File\n"
+HTTPONLY_PREFIX = '#HttpOnly_'
+
+
+def domain_matches(domain, domains):
+    """Относится ли домен куки к одному из `domains` (сам домен или поддомен); пустой список — любой."""
+    domain = domain.lstrip('.').lower()
+    return not domains or any(domain == d or domain.endswith('.' + d) for d in domains)
+
+
+def entry_domain(line):
+    """Домен строки cookies.txt или None для комментариев и пустых строк."""
+    if line.startswith(HTTPONLY_PREFIX):
+        line = line[len(HTTPONLY_PREFIX):]
+    elif line.startswith('#') or not line.strip():
+        return None
+    return line.split('\t', 1)[0]
+
+
+class CookieStore:
+    """
+    Общая разобранная копия cookies.txt для всех задач.
+
+    Из файла разбираются только куки доменов `domains`. Все экземпляры YoutubeDL
+    используют один и тот же jar; если mtime файла изменился, файл разбирается
+    заново и содержимое jar подменяется на месте, так что новые куки сразу видят
+    все задачи. Пока файл не меняется, refresh() стоит один stat().
+
+    Если файла нет, один раз вызывается `export(path, domains)` (см. refresh.py),
+    чтобы взять куки из браузера.
+    """
+
+    def __init__(self, path, domains=(), export=None):
+        self.path = path
+        self.domains = tuple(d.lstrip('.').lower() for d in domains)
+        self.export = export
+        self._lock = threading.Lock()
+        self._jar = None
+        self._mtime = None
+        self._exported = False
+        self.loads = 0
+        self.count = 0
+
+    def __reduce__(self):
+        # process-mode download workers get their own store over the same file
+        return CookieStore, (self.path, self.domains)
+
+    def _read(self):
+        buf = io.StringIO()
+        buf.write(NETSCAPE_HEADER)
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                domain = entry_domain(line)
+                if domain is not None and domain_matches(domain, self.domains):
+                    buf.write(line)
+        buf.seek(0)
+        return buf
+
+    def _load(self, mtime):
+        from yt_dlp.cookies import YoutubeDLCookieJar
+        jar = YoutubeDLCookieJar()
+        if mtime is not None:
+            jar.load(self._read())
+        return jar
+
+    def _export_once(self):
+        if self._exported or self.export is None or os.path.exists(self.path):
+            return
+        self._exported = True
+        try:
+            self.export(self.path, self.domains)
+        except Exception as e:
+            logger.warning(f"No {os.path.basename(self.path)} and cannot export browser cookies: {e}")
+
+    def refresh(self):
+        """Перечитать файл, если он изменился. Возвращает True, если jar обновлён."""
+        with self._lock:
+            self._export_once()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if self._jar is not None and mtime == self._mtime:
+                return False
+            self._mtime = mtime
+            try:
+                fresh = self._load(mtime)
+            except Exception as e:
+                # a broken file keeps the previous cookies until it changes again
+                logger.error(f"Cannot load cookies from {self.path}: {e}")
+                if self._jar is None:
+                    self._jar = self._load(None)
+                return False
+            if self._jar is None:
+                self._jar = fresh
+            else:
+                # swap the contents, not the object: request handlers of pooled YoutubeDLs hold this jar
+                with self._jar._cookies_lock:
+                    self._jar._cookies = fresh._cookies
+            self.loads += 1
+            self.count = len(fresh)
+        logger.info(f"Loaded {self.count} cookies for {', '.join(self.domains) or 'all domains'}")
+        return True
+
+    def jar(self):
+        """Общий YoutubeDLCookieJar (актуальный на момент вызова)."""
+        self.refresh()
+        return self._jar
@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """
+    Постоянный кеш Telegram file_id для уже отправленных файлов.
+
+    Ключ — (id ролика, вариант), где вариант это `720p`, `mp3`, `opus` и т.п.
+    Повторный запрос того же варианта отправляется по file_id без скачивания
+    и загрузки. Запись удаляется, если отправка по сохранённому file_id не удалась.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            " media_id TEXT NOT NULL,"
+            " variant TEXT NOT NULL,"
+            " file_id TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " PRIMARY KEY (media_id, variant))"
+        )
+
+    def get(self, media_id, variant):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM file_ids WHERE media_id = ? AND variant = ?",
+                (media_id, variant)
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, media_id, variant, file_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_ids (media_id, variant, file_id, created) VALUES (?, ?, ?, ?)",
+                (media_id, variant, file_id, time.time())
+            )
+
+    def invalidate(self, media_id, variant):
+        self.invalidations += 1
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM file_ids WHERE media_id = ? AND variant = ?", (media_id, variant)
+            )
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'entries': size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
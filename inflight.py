@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class _SharedJob:
+    __slots__ = ('task', 'hooks', 'refs', 'cleanup')
+
+    def __init__(self, cleanup):
+        self.task = None
+        self.hooks = []
+        self.refs = 0
+        self.cleanup = cleanup
+
+
+class SharedDownloads:
+    """
+    Объединение одинаковых одновременных загрузок.
+
+    Все, кто запросил один и тот же ключ (id ролика, формат), пока загрузка идёт
+    или её результат ещё кем-то отправляется, ждут одну задачу. Каждый участник
+    получает события прогресса в свой хук, а `cleanup` вызывается один раз —
+    когда последний участник вышел из блока.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self.started = 0
+        self.merged = 0
+
+    def __len__(self):
+        return len(self._jobs)
+
+    @asynccontextmanager
+    async def join(self, key, start, hook=None, cleanup=None):
+        """
+        Присоединиться к загрузке `key` или начать её вызовом `start(fanout_hook)`.
+        Внутри блока доступен результат `start`; ошибка загрузки пробрасывается всем участникам.
+        """
+        job = self._jobs.get(key)
+        if job is None:
+            job = _SharedJob(cleanup)
+            self._jobs[key] = job
+            job.task = asyncio.create_task(start(lambda d: self._fanout(job, d)))
+            job.task.add_done_callback(lambda t: self._forget_failed(key, job, t))
+            self.started += 1
+        else:
+            self.merged += 1
+            logger.info(f"Joined in-flight download {key} ({job.refs} already waiting)")
+        job.refs += 1
+        if hook is not None:
+            job.hooks.append(hook)
+
+        try:
+            try:
+                result = await asyncio.shield(job.task)
+            finally:
+                if hook is not None and hook in job.hooks:
+                    job.hooks.remove(hook)
+            yield result
+        finally:
+            job.refs -= 1
+            if job.refs == 0:
+                self._release(key, job)
+
+    @staticmethod
+    def _fanout(job, d):
+        # called from download threads; iterate over a snapshot
+        for hook in list(job.hooks):
+            try:
+                hook(d)
+            except Exception as e:
+                logger.error(f"Progress hook failed: {e}")
+
+    def _forget_failed(self, key, job, task):
+        # a failed download must not be reused by the next requester
+        if (task.cancelled() or task.exception() is not None) and self._jobs.get(key) is job:
+            del self._jobs[key]
+
+    def _release(self, key, job):
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+        if job.cleanup is None:
+            return
+        if job.task.done():
+            self._run_cleanup(job)
+        else:
+            job.task.add_done_callback(lambda _: self._run_cleanup(job))
+
+    @staticmethod
+    def _run_cleanup(job):
+        try:
+            job.cleanup()
+        except Exception as e:
+            logger.error(f"Download cleanup failed: {e}")
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+_YT_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com')
+_YT_PATH_RE = re.compile(r"^/(?:shorts|embed|live|v)/([\w-]{11})")
+_YANDEX_TRACK_RE = re.compile(r"/track/(\d+)")
+
+# Only these fields of extract_info are used downstream; everything else is dropped before caching
+_INFO_KEYS = ('id', 'title', 'uploader', 'artist', 'duration', 'thumbnail', 'webpage_url', 'extractor_key')
+_FORMAT_KEYS = ('format_id', 'height', 'ext', 'vcodec', 'acodec', 'filesize', 'filesize_approx', 'tbr')
+
+
+def canonical_id(url):
+    """
+    Канонический ключ ролика/трека по ссылке: `youtube:<id>` или `yandex:<id>`.
+    youtu.be/X, watch?v=X и music.youtube.com/watch?v=X дают один и тот же ключ.
+    Для нераспознанных ссылок возвращает None.
+    """
+    try:
+        parsed = urlparse(url.strip())
+    except ValueError:
+        return None
+    host = (parsed.hostname or '').lower()
+    if host == 'youtu.be':
+        vid = parsed.path.lstrip('/').split('/')[0]
+        return f"youtube:{vid}" if vid else None
+    if host in _YT_HOSTS:
+        vid = parse_qs(parsed.query).get('v', [None])[0]
+        if not vid:
+            m = _YT_PATH_RE.match(parsed.path)
+            vid = m.group(1) if m else None
+        return f"youtube:{vid}" if vid else None
+    if host.startswith('music.yandex.'):
+        m = _YANDEX_TRACK_RE.search(parsed.path)
+        return f"yandex:{m.group(1)}" if m else None
+    return None
+
+
+def compact_info(info):
+    """Урезать результат extract_info до полей, нужных обработчикам и манифесту."""
+    slim = {k: info.get(k) for k in _INFO_KEYS}
+    if not slim['thumbnail'] and info.get('thumbnails'):
+        slim['thumbnail'] = info['thumbnails'][-1].get('url')
+    slim['formats'] = [
+        {k: f.get(k) for k in _FORMAT_KEYS}
+        for f in info.get('formats') or []
+    ]
+    return slim
+
+
+class ExtractCache:
+    """
+    Кеш результатов extract_info с TTL и LRU-вытеснением.
+
+    Ключ — канонический id ролика, поэтому разные формы одной ссылки попадают
+    в одну запись. Параллельные запросы одного id ждут один общий future,
+    а не запускают несколько извлечений.
+    """
+
+    def __init__(self, ttl=1800.0, max_entries=512):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, info = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return info
+
+    def _store(self, key, info):
+        self._entries[key] = (time.monotonic(), info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, url, fetch):
+        """
+        Вернуть info для `url`, при промахе вызвав `fetch(url)` в пуле потоков.
+        Ошибки не кешируются и передаются всем ожидающим.
+        """
+        key = canonical_id(url) or url
+        info = self._lookup(key)
+        if info is not None:
+            self.hits += 1
+            return info
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.hits += 1
+            return await asyncio.shield(fut)
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._inflight[key] = fut
+        try:
+            info = compact_info(await loop.run_in_executor(None, fetch, url))
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # mark retrieved so a lone failure does not log "exception was never retrieved"
+            fut.exception()
+            raise
+        else:
+            self._store(key, info)
+            fut.set_result(info)
+            return info
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, url):
+        self._entries.pop(canonical_id(url) or url, None)
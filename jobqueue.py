@@ -0,0 +1,192 @@
+import json
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedJob:
+    __slots__ = ('id', 'kind', 'payload', 'status', 'worker', 'attempts', 'progress', 'result', 'seq')
+
+    def __init__(self, row):
+        (self.id, self.kind, payload, self.status, self.worker,
+         self.attempts, self.progress, result, self.seq) = row
+        self.payload = json.loads(payload)
+        self.result = json.loads(result) if result else None
+
+
+_COLUMNS = "id, kind, payload, status, worker, attempts, progress, result, seq"
+
+
+class JobQueue:
+    """
+    Очередь задач в SQLite (WAL) между фронтендом бота и процессами-воркерами.
+
+    Фронтенд кладёт задачи через submit(), воркеры забирают их claim() и
+    регулярно обновляют heartbeat(), заодно передавая текст прогресса.
+    Задача, чей воркер перестал присылать heartbeat, возвращается в очередь
+    recover() (или помечается failed после `max_attempts` попыток).
+    Каждое изменение строки получает новый `seq` из счётчика, который не
+    уменьшается и после delete(), по нему фронтенд забирает только
+    изменившиеся задачи через changed().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " worker TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " progress TEXT,"
+            " result TEXT,"
+            " seq INTEGER NOT NULL,"
+            " heartbeat REAL,"
+            " created REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_seq ON jobs(seq)")
+        # finished rows are deleted, so MAX(seq) over jobs could go back: the counter lives in its own row
+        self._conn.execute("CREATE TABLE IF NOT EXISTS seq_counter (value INTEGER NOT NULL)")
+        self._conn.execute(
+            "INSERT INTO seq_counter (value) SELECT (SELECT COALESCE(MAX(seq), 0) FROM jobs)"
+            " WHERE NOT EXISTS (SELECT 1 FROM seq_counter)"
+        )
+
+    def _next_seq(self):
+        # called inside a write transaction
+        self._conn.execute("UPDATE seq_counter SET value = value + 1")
+        return self._conn.execute("SELECT value FROM seq_counter").fetchone()[0]
+
+    def _write(self, sql, params):
+        # seq is bumped inside the same write transaction, so readers never skip a change
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._next_seq()
+                cur = self._conn.execute(sql, (seq,) + tuple(params))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cur
+
+    def submit(self, kind, payload):
+        cur = self._write(
+            "INSERT INTO jobs (seq, kind, payload, status, created) VALUES (?, ?, ?, 'queued', ?)",
+            (kind, json.dumps(payload, ensure_ascii=False, separators=(',', ':')), time.time())
+        )
+        return cur.lastrowid
+
+    def claim(self, worker):
+        """Забрать самую старую задачу из очереди или вернуть None."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                seq = self._next_seq()
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, heartbeat = ?,"
+                    " attempts = attempts + 1, seq = ? WHERE id = ?",
+                    (worker, time.time(), seq, row[0])
+                )
+                job = self._conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (row[0],)).fetchone()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return QueuedJob(job)
+
+    def heartbeat(self, job_id, worker, progress=None):
+        """
+        Подтвердить, что воркер жив, и (если задан) обновить текст прогресса.
+        Возвращает False, если задача уже отдана другому воркеру.
+        """
+        if progress is None:
+            with self._lock:
+                cur = self._conn.execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                    (time.time(), job_id, worker)
+                )
+        else:
+            cur = self._write(
+                "UPDATE jobs SET seq = ?, heartbeat = ?, progress = ?"
+                " WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), progress, job_id, worker)
+            )
+        return cur.rowcount > 0
+
+    def complete(self, job_id, worker, result=None):
+        return self._finish(job_id, worker, 'done', result)
+
+    def fail(self, job_id, worker, error):
+        return self._finish(job_id, worker, 'failed', {'error': str(error)})
+
+    def _finish(self, job_id, worker, status, result):
+        cur = self._write(
+            "UPDATE jobs SET seq = ?, status = ?, result = ?"
+            " WHERE id = ? AND worker = ? AND status = 'running'",
+            (status, json.dumps(result, ensure_ascii=False), job_id, worker)
+        )
+        return cur.rowcount > 0
+
+    def release(self, job_id, worker):
+        """Вернуть незавершённую задачу в очередь (воркер останавливается), попытка не засчитывается."""
+        cur = self._write(
+            "UPDATE jobs SET seq = ?, status = 'queued', worker = NULL, attempts = attempts - 1"
+            " WHERE id = ? AND worker = ? AND status = 'running'",
+            (job_id, worker)
+        )
+        return cur.rowcount > 0
+
+    def recover(self, timeout, max_attempts=3):
+        """Вернуть в очередь задачи воркеров, молчащих дольше `timeout` секунд."""
+        deadline = time.time() - timeout
+        failed = self._write(
+            "UPDATE jobs SET seq = ?, status = 'failed', result = ?"
+            " WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+            (json.dumps({'error': "worker died"}), deadline, max_attempts)
+        ).rowcount
+        requeued = self._write(
+            "UPDATE jobs SET seq = ?, status = 'queued', worker = NULL"
+            " WHERE status = 'running' AND heartbeat < ?",
+            (deadline,)
+        ).rowcount
+        if requeued or failed:
+            logger.warning(f"Recovered jobs of dead workers: {requeued} requeued, {failed} failed")
+        return requeued
+
+    def changed(self, since):
+        """Задачи, изменившиеся после `seq` = since, по порядку изменений."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM jobs WHERE seq > ? ORDER BY seq", (since,)
+            ).fetchall()
+        return [QueuedJob(row) for row in rows]
+
+    def delete(self, job_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,101 @@
+import json
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+STATES = ('queued', 'downloading', 'postprocessing', 'uploading', 'done')
+# Finished rows are kept for a while for inspection, then swept on the next finish()
+DONE_TTL = 86400
+
+
+class JournalEntry:
+    __slots__ = ('id', 'kind', 'payload', 'state', 'progress', 'attempts')
+
+    def __init__(self, row):
+        self.id, self.kind, payload, self.state, progress, self.attempts = row
+        self.payload = json.loads(payload)
+        self.progress = json.loads(progress) if progress else {}
+
+
+class JobJournal:
+    """
+    Журнал задач в SQLite (WAL): что делается и на каком этапе.
+
+    Каждая задача cb_handler записывается при старте вместе со всем, что нужно
+    для её повтора (см. job_payload), и переходит по состояниям queued →
+    downloading → postprocessing → uploading → done. Если процесс перезапустился,
+    unfinished() отдаёт незавершённые задачи: их можно продолжить с частично
+    скачанных файлов и тем же статус-сообщением. `attempts` считает запуски
+    задачи (resume() добавляет один), чтобы задача, которая роняет процесс,
+    не перезапускалась бесконечно.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " progress TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 1,"
+            " updated REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(journal)")}
+        if 'attempts' not in columns:
+            # journals written before attempts were counted
+            self._conn.execute("ALTER TABLE journal ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS journal_state ON journal(state)")
+
+    def start(self, kind, payload):
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO journal (kind, payload, state, updated) VALUES (?, ?, 'queued', ?)",
+                (kind, json.dumps(payload, ensure_ascii=False, separators=(',', ':')), time.time())
+            )
+        return cur.lastrowid
+
+    def update(self, job_id, state=None, progress=None):
+        """Записать новое состояние и/или прогресс (словарь, заменяется целиком)."""
+        if state is not None and state not in STATES:
+            raise ValueError(f"Unknown job state: {state}")
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET state = COALESCE(?, state), progress = COALESCE(?, progress), updated = ?"
+                " WHERE id = ?",
+                (state, json.dumps(progress) if progress is not None else None, time.time(), job_id)
+            )
+
+    def resume(self, job_id):
+        """Отметить ещё один запуск задачи после перезапуска; возвращает число запусков."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET attempts = attempts + 1, updated = ? WHERE id = ?", (time.time(), job_id)
+            )
+            row = self._conn.execute("SELECT attempts FROM journal WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else 0
+
+    def finish(self, job_id):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("UPDATE journal SET state = 'done', updated = ? WHERE id = ?", (now, job_id))
+            self._conn.execute("DELETE FROM journal WHERE state = 'done' AND updated < ?", (now - DONE_TTL,))
+
+    def unfinished(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, payload, state, progress, attempts FROM journal WHERE state != 'done' ORDER BY id"
+            ).fetchall()
+        return [JournalEntry(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
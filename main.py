@@ -4,14 +4,41 @@ import logging
 import asyncio
 import glob
 import time
+import shutil
+import tempfile
+from contextlib import AsyncExitStack
+from types import SimpleNamespace
 
 import re
-import requests
-import yt_dlp
+# cold start is measured from here; yt_dlp is imported later by the YoutubeDL pool
+STARTED_AT = time.perf_counter()
 from dotenv import load_dotenv
-from pyrogram import Client, filters, idle
+from pyrogram import filters, idle
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 
+from session_store import SessionStore
+from manifest import MediaManifest, pick_thumbnail
+from info_cache import ExtractCache, canonical_id
+from file_id_cache import FileIdCache
+from scheduler import JobScheduler, PRIORITY_AUDIO, PRIORITY_VIDEO
+from workers import DownloadRunner
+from inflight import SharedDownloads
+from progress import ProgressService
+from thumbs import HttpClient, ThumbnailCache
+from users import UserRegistry
+from metrics import Metrics
+from media_cache import MediaCache, STAGING
+from jobqueue import JobQueue
+from journal import JobJournal
+from ydl_pool import YdlPool
+from cookie_store import CookieStore
+from planner import plan_video, plan_source, codec_family, copy_saving
+from transcode import Transcoder
+from bandwidth import BandwidthManager, MBIT
+from uploader import UploadClient
+from tagger import write_tags, metadata_pass_cost
+from batch import BatchPipeline, PLAYLIST_RE, lazy_entries
+
 # Logging configuration
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -46,29 +73,55 @@ with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
     _cfg = json.load(f)
     COOLDOWN_TIME = float(_cfg.get('edit_cooldown', 0.5))
     SESSIONS_FILE = os.path.join(BASE_DIR, _cfg.get('sessions_file', "sessions.json"))
+    SESSIONS_DB = os.path.join(BASE_DIR, _cfg.get('sessions_db', "sessions.db"))
+    SESSION_TTL = float(_cfg.get('session_ttl', 86400))
     USERS_FILE = os.path.join(BASE_DIR, _cfg.get('users_file', "users.json"))
+    USERS_LOG = os.path.join(BASE_DIR, _cfg.get('users_log', "users.log"))
+    USERS_FLUSH_INTERVAL = float(_cfg.get('users_flush_interval', 5))
+    METRICS_PORT = int(_cfg.get('metrics_port', 0))
+    METRICS_FILE = _cfg.get('metrics_file') or None
     DOWNLOAD_DIR = os.path.join(BASE_DIR, _cfg.get('download_dir', "downloads"))
-
-# Force rate limit: exactly 2 edits per second (0.5s interval)
-RATE_LIMIT_INTERVAL = 0.5
-# Keep COOLDOWN_TIME for backward compatibility but enforce RATE_LIMIT_INTERVAL
-COOLDOWN_TIME = RATE_LIMIT_INTERVAL
-
-last_status = {"text": None}
-_last_edit_ts = 0.0
-
-# Async lock to serialize edits and avoid race conditions
-_EDIT_LOCK = asyncio.Lock()
-
-# Ensure required files and directories exist
+    INFO_CACHE_TTL = float(_cfg.get('info_cache_ttl', 1800))
+    INFO_CACHE_SIZE = int(_cfg.get('info_cache_size', 512))
+    FILE_IDS_DB = os.path.join(BASE_DIR, _cfg.get('file_ids_db', "file_ids.db"))
+    MAX_JOBS = int(_cfg.get('max_jobs', 4))
+    MAX_JOBS_PER_USER = int(_cfg.get('max_jobs_per_user', 1))
+    WORKER_MODE = _cfg.get('worker_mode', "thread")
+    EDIT_RATE_GLOBAL = float(_cfg.get('edit_rate_global', 25))
+    THUMBS_DIR = os.path.join(BASE_DIR, _cfg.get('thumbs_dir', "thumbs"))
+    THUMBS_MAX_MB = float(_cfg.get('thumbs_max_mb', 50))
+    MEDIA_CACHE_MB = float(_cfg.get('media_cache_mb', 2048))
+    TRANSCODE_JOBS = int(_cfg.get('transcode_jobs', 0)) or None
+    # Telegram accepts files up to 2000 MB from bots over MTProto
+    MAX_UPLOAD = int(float(_cfg.get('max_upload_mb', 2000)) * 1024 * 1024)
+    QUEUE_MODE = bool(_cfg.get('queue_mode', False))
+    QUEUE_DB = os.path.join(BASE_DIR, _cfg.get('queue_db', "jobs.db"))
+    JOURNAL_DB = os.path.join(BASE_DIR, _cfg.get('journal_db', "journal.db"))
+    WORKER_JOBS = int(_cfg.get('worker_jobs', 0)) or MAX_JOBS
+    HEARTBEAT_INTERVAL = float(_cfg.get('heartbeat_interval', 5))
+    HEARTBEAT_TIMEOUT = float(_cfg.get('heartbeat_timeout', 30))
+    JOB_ATTEMPTS = int(_cfg.get('job_attempts', 3))
+    YDL_POOL_SIZE = int(_cfg.get('ydl_pool_size', 0)) or MAX_JOBS
+    DOWNLOAD_BUDGET = float(_cfg.get('download_budget_mbps', 0)) * MBIT
+    UPLOAD_BUDGET = float(_cfg.get('upload_budget_mbps', 0)) * MBIT
+    FRAGMENT_THREADS = int(_cfg.get('fragment_threads', 16))
+    MAX_FRAGMENTS = int(_cfg.get('max_fragments', 8))
+    UPLOAD_CONNECTIONS = int(_cfg.get('upload_connections', 4))
+    UPLOAD_PART_RETRIES = int(_cfg.get('upload_part_retries', 5))
+    UPLOAD_RESUME_TTL = float(_cfg.get('upload_resume_ttl', 3600))
+    COOKIES_FILE = os.path.join(BASE_DIR, _cfg.get('cookies_file', "cookies.txt"))
+    COOKIE_DOMAINS = _cfg.get('cookie_domains') or ["yandex.ru", "yandex.com", "yandex.by", "yandex.kz"]
+    BATCH_MAX_ITEMS = int(_cfg.get('batch_max_items', 50))
+    BATCH_PREFETCH = int(_cfg.get('batch_prefetch', 3))
+
+# How often the front end and workers poll the job queue
+QUEUE_POLL_INTERVAL = 1.0
+
+# Status message edits: COOLDOWN_TIME per chat, EDIT_RATE_GLOBAL edits/s for the whole bot
+progress = ProgressService(per_chat_interval=COOLDOWN_TIME, global_rate=EDIT_RATE_GLOBAL)
+
+# Ensure required directories exist
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-for path, default in (
-    (USERS_FILE, []),
-    (SESSIONS_FILE, {})
-):
-    if not os.path.isfile(path):
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(default, f, ensure_ascii=False, indent=2)
 
 # Load environment variables
 load_dotenv(override=True)
@@ -79,27 +132,125 @@ if not all([API_ID, API_HASH, BOT_TOKEN]):
     logger.error("ENV vars missing")
     exit(1)
 
-# Initialize bot client
+# Initialize bot client; files from disk are uploaded in parallel parts over UPLOAD_CONNECTIONS sessions
 token = BOT_TOKEN
-app = Client("ytbot", api_id=API_ID, api_hash=API_HASH, bot_token=token)
+app = UploadClient(
+    "ytbot", api_id=API_ID, api_hash=API_HASH, bot_token=token,
+    upload_connections=UPLOAD_CONNECTIONS, part_retries=UPLOAD_PART_RETRIES, resume_ttl=UPLOAD_RESUME_TTL
+)
+
+# Session management on disk: keyed SQLite store, legacy sessions.json is imported once
+sessions = SessionStore(SESSIONS_DB, ttl=SESSION_TTL)
+sessions.migrate_json(SESSIONS_FILE)
+
+# extract_info results shared between users, keyed by canonical video id
+info_cache = ExtractCache(ttl=INFO_CACHE_TTL, max_entries=INFO_CACHE_SIZE)
+
+# Telegram file_id of already delivered files, keyed by (video id, resolution/audio format)
+file_ids = FileIdCache(FILE_IDS_DB)
+
+# Base YoutubeDL options per profile; a job only adds format, output template, hooks and postprocessors
+USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+    'AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/115.0.0.0 Safari/537.36'
+)
+YDL_PROFILES = {
+    'video': {'http_headers': {'User-Agent': USER_AGENT}},
+    'audio': {'http_headers': {'User-Agent': USER_AGENT}},
+    'yandex': {'http_headers': {'User-Agent': USER_AGENT}},
+}
+
+
+def export_cookies(path, domains):
+    # refresh.py imports yt_dlp, so it is loaded only when cookies.txt is missing
+    import refresh
+    added, _, _ = refresh.export(path, domains)
+    logger.info(f"Exported {added} browser cookies to {path}")
+
 
-# Session management on disk
-def load_sessions():
-    with open(SESSIONS_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+# Parsed cookies.txt shared by every Yandex job, reloaded when the file changes (see refresh.py)
+cookies = CookieStore(COOKIES_FILE, COOKIE_DOMAINS, export=export_cookies)
 
-def save_sessions(sessions):
-    with open(SESSIONS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(sessions, f, ensure_ascii=False, indent=2)
+# Reusable YoutubeDL instances: extractors, cookies and connections are set up once per profile
+ydl_pool = YdlPool(
+    YDL_PROFILES, YDL_POOL_SIZE, cookies={'yandex': cookies},
+    on_lease=lambda profile, seconds, reused: metrics.observe(
+        'ydl_setup_seconds', seconds, profile=profile, reused=reused
+    )
+)
+
+# Seconds from process start until the bot was connected, set in main()
+cold_start = 0.0
+
+# Bounded download pool with per-user fairness
+scheduler = JobScheduler(global_limit=MAX_JOBS, per_user_limit=MAX_JOBS_PER_USER)
+_runner = None
+
+# Concurrent fragments per download and the download/upload budgets shared by all jobs
+bandwidth = BandwidthManager(DOWNLOAD_BUDGET, UPLOAD_BUDGET, FRAGMENT_THREADS, MAX_FRAGMENTS)
+
+# Pooled HTTP client and on-disk cover cache shared by all jobs
+http_client = HttpClient()
+thumbs = ThumbnailCache(THUMBS_DIR, THUMBS_MAX_MB * 1024 * 1024, http_client)
+
+# Finished files keyed by (video id, format), kept for retries and repeat requests
+media_cache = MediaCache(DOWNLOAD_DIR, MEDIA_CACHE_MB * 1024 * 1024)
+
+# Local ffmpeg conversions of kept source tracks, run in parallel
+transcoder = Transcoder(TRANSCODE_JOBS)
+
+# Identical (video id, format) downloads in flight, shared between requesters
+shared_downloads = SharedDownloads()
+
+# queue_mode: this process is only the Telegram front end, downloads run in worker.py processes
+job_queue = JobQueue(QUEUE_DB) if QUEUE_MODE else None
+
+# Local jobs with their state, resumed after a restart (queue_mode jobs are recovered by the queue)
+journal = JobJournal(JOURNAL_DB) if job_queue is None else None
+
+# Per-stage job timings and service gauges, exported in Prometheus text format
+metrics = Metrics()
+metrics.gauge('queue_depth', lambda: scheduler.queued, "Download jobs waiting for a slot")
+metrics.gauge('active_jobs', lambda: scheduler.running, "Download jobs holding a slot")
+metrics.gauge('inflight_downloads', lambda: len(shared_downloads), "Distinct downloads in flight")
+metrics.gauge('merged_downloads', lambda: shared_downloads.merged, "Requests merged into an in-flight download")
+metrics.gauge('edit_backlog', lambda: progress.backlog, "Status edits waiting for the rate limiter")
+metrics.gauge('edits_replaced', lambda: progress.replaced, "Queued status edits superseded by newer text")
+metrics.gauge('info_cache_hits', lambda: info_cache.hits, "extract_info cache hits")
+metrics.gauge('info_cache_misses', lambda: info_cache.misses, "extract_info cache misses")
+metrics.gauge('file_id_cache_hits', lambda: file_ids.hits, "Deliveries answered by cached file_id")
+metrics.gauge('file_id_cache_misses', lambda: file_ids.misses, "Deliveries without cached file_id")
+metrics.gauge('media_cache_bytes', lambda: media_cache.total, "Bytes of finished files and kept source tracks in the media cache")
+metrics.gauge('media_cache_hits', lambda: media_cache.hits, "Downloads answered by a cached local file")
+metrics.gauge('media_cache_evictions', lambda: media_cache.evictions, "Files evicted from the media cache")
+metrics.gauge('ydl_pool_built', lambda: ydl_pool.built, "YoutubeDL instances built")
+metrics.gauge('ydl_pool_reused', lambda: ydl_pool.reused, "Jobs served by a pooled YoutubeDL instance")
+metrics.gauge('ydl_pool_idle', lambda: ydl_pool.idle(), "Idle pooled YoutubeDL instances")
+metrics.gauge('cookies_loaded', lambda: cookies.count, "Cookies in the shared jar")
+metrics.gauge('cookies_reloads', lambda: cookies.loads, "cookies.txt parses (initial load and changes)")
+metrics.gauge('fragment_threads', lambda: bandwidth.allocated, "Concurrent fragment downloads given to running jobs")
+metrics.gauge('download_throttled_seconds', lambda: bandwidth.download_bucket.waited if bandwidth.download_bucket else 0,
+              "Seconds downloads slept to stay within download_budget_mbps")
+metrics.gauge('upload_throttled_seconds', lambda: bandwidth.upload_bucket.waited if bandwidth.upload_bucket else 0,
+              "Seconds uploads waited to stay within upload_budget_mbps")
+metrics.gauge('upload_part_retries', lambda: app.uploader.retries, "File parts uploaded again after an error")
+metrics.gauge('uploads_resumed', lambda: app.uploader.resumed, "Uploads continued from parts already on the server")
+metrics.gauge('cold_start_seconds', lambda: cold_start, "Seconds from process start until the bot was connected")
+if job_queue is not None:
+    metrics.gauge('queue_jobs_queued', lambda: job_queue.counts().get('queued', 0), "Jobs waiting for a worker")
+    metrics.gauge('queue_jobs_running', lambda: job_queue.counts().get('running', 0), "Jobs claimed by workers")
+metrics.describe('stage_seconds', "Duration of job stages")
+metrics.describe('planner_cpu_seconds_saved_total', "Estimated ffmpeg CPU-seconds avoided by the format planner")
+metrics.describe('stage_bytes_total', "Bytes processed per job stage")
+metrics.describe('stage_seconds_saved_total', "Estimated seconds saved per job stage (mutagen tags instead of an ffmpeg pass)")
+metrics.describe('ydl_setup_seconds', "Time to get a configured YoutubeDL for a job")
+
+# Known users: in-memory set, new ids are appended to USERS_LOG in batches
+users = UserRegistry(USERS_LOG, legacy_path=USERS_FILE, flush_interval=USERS_FLUSH_INTERVAL)
 
 def track_user(user_id: int):
-    with open(USERS_FILE, 'r+', encoding='utf-8') as f:
-        users = json.load(f)
-        if user_id not in users:
-            users.append(user_id)
-            f.seek(0)
-            json.dump(users, f, ensure_ascii=False, indent=2)
-            f.truncate()
+    users.add(user_id)
 
 
 def get_msg_id(message):
@@ -123,43 +274,226 @@ def make_session_key(message):
 
 # Centralized, rate-limited editor
 async def safe_edit_text(msg, text):
-    """Редактировать сообщение, соблюдая глобальный лимит RATE_LIMIT_INTERVAL.
+    """Поставить правку сообщения в ProgressService.
 
-    Все вызовы должны идти через этот метод (через create_task/loop).
-    Он сериализует правки с помощью _EDIT_LOCK и ждёт нужный интервал между правками.
+    Все правки статусов должны идти через этот метод или через хуки ниже.
+    Сервис сам соблюдает лимиты на чат и на бота, а более новый текст
+    заменяет ещё не отправленный.
     """
-    global _last_edit_ts
-    async with _EDIT_LOCK:
-        now = time.monotonic()
-        elapsed = now - _last_edit_ts
-        wait = RATE_LIMIT_INTERVAL - elapsed
-        if wait > 0:
-            await asyncio.sleep(wait)
-        try:
-            await msg.edit_text(text)
-        except Exception:
-            # игнорируем ошибки редактирования (пользователь удалил сообщение, флоуд и т.п.)
+    progress.update(msg, text)
+
+
+def download_progress(status, last_status):
+    """Хук прогресса yt-dlp для статус-сообщения; вызывается из потока загрузки."""
+    loop = asyncio.get_running_loop()
+
+    def hook(d):
+        if d.get('status') != 'downloading':
             return
-        _last_edit_ts = time.monotonic()
+        total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+        cur = d.get('downloaded_bytes', 0)
+        pct = int(cur * 100 / total) if total else 0
+        status_text = f"📥 Скачивание... {pct}%"
+        if status_text != last_status.get("text"):
+            last_status["text"] = status_text
+            progress.update_threadsafe(loop, status, status_text)
+    return hook
+
+
+def upload_progress(status, last_status):
+    """Колбэк прогресса отправки pyrogram для статус-сообщения; заодно держит отправку в бюджете."""
+    throttle = bandwidth.upload_throttle()
+
+    async def send_progress(cur, tot):
+        await throttle(cur, tot)
+        pct = int(cur * 100 / tot) if tot else 0
+        status_text = f"🚀 Отправка... {pct}%"
+        if status_text != last_status.get("text"):
+            last_status["text"] = status_text
+            progress.update(status, status_text)
+    return send_progress
+
+
+def delivery_variant(data, link_type):
+    """Вариант доставки (kind, variant) для нажатой кнопки или None, если это не скачивание."""
+    if data.startswith('video:') and link_type == 'video':
+        return 'video', f"{int(data.split(':')[1])}p"
+    if data.startswith('audioformat:') and link_type == 'audio':
+        return 'audio', data.split(':')[1]
+    if data == 'audio' and link_type == 'video':
+        return 'audio', 'opus'
+    return None
+
+
+async def send_cached(message, media_id, kind, variant, title, author, reply_markup, file_id=None):
+    """
+    Отправить ранее загруженный файл по сохранённому file_id (или по уже найденному `file_id`).
+    Возвращает отправленное сообщение или None; при ошибке отправки запись из кеша удаляется.
+    """
+    if file_id is None:
+        file_id = file_ids.get(media_id, variant)
+    if file_id is None:
+        return None
+    try:
+        if kind == 'video':
+            sent = await message.reply_video(
+                file_id,
+                caption=f"{title} — {author}",
+                supports_streaming=True,
+                reply_markup=reply_markup
+            )
+        else:
+            sent = await message.reply_audio(
+                file_id,
+                caption=f"{title} - {author} 🎧",
+                title=title,
+                performer=author,
+                reply_markup=reply_markup
+            )
+    except Exception as e:
+        logger.warning(f"Cached file_id for {media_id}/{variant} failed, invalidating: {e}")
+        file_ids.invalidate(media_id, variant)
+        return None
+    logger.info(f"file_id cache hit for {media_id}/{variant} ({file_ids.stats()})")
+    return sent
+
+
+async def send_cached_formats(message, media_id, fmts, title, author, reply_markup):
+    """
+    Отправить по file_id те аудиоформаты из `fmts`, что уже отправлялись.
+    Возвращает (форматы, которые придётся скачать, последнее отправленное сообщение);
+    `reply_markup` получает последнее сообщение, если скачивать больше нечего.
+    """
+    pending, sent = [], None
+    for i, fmt in enumerate(fmts):
+        tail = not pending and i == len(fmts) - 1
+        msg = await send_cached(message, media_id, 'audio', fmt, title, author, reply_markup if tail else None)
+        if msg:
+            sent = msg
+        else:
+            pending.append(fmt)
+    return pending, sent
+
+
+def human_size(n):
+    if n >= 1024 ** 3:
+        return f"{n / 1024 ** 3:.1f} GB"
+    return f"{max(n // (1024 * 1024), 1)} MB"
+
+
+async def upload_parts(path, duration, job, send):
+    """
+    Отправить файл через `send(part, suffix, last)`. Файл больше MAX_UPLOAD режется
+    ffmpeg'ом на части без перекодирования и уходит серией сообщений.
+    Возвращает (последнее отправленное сообщение, число частей).
+    """
+    size = os.path.getsize(path)
+    if size <= MAX_UPLOAD:
+        with job.stage('upload'):
+            sent = await send(path, '', True)
+        job.add_bytes('upload', size)
+        return sent, 1
+
+    directory = tempfile.mkdtemp(prefix='split-', dir=os.path.join(DOWNLOAD_DIR, STAGING))
+    try:
+        with job.stage('split'):
+            parts = await transcoder.split(path, MAX_UPLOAD, directory, duration)
+        sent = None
+        for i, part in enumerate(parts, 1):
+            with job.stage('upload'):
+                sent = await send(part, f" ({i}/{len(parts)})", i == len(parts))
+            job.add_bytes('upload', os.path.getsize(part))
+        return sent, len(parts)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def use_plan(job, plan, opts):
+    """Применить план форматов к опциям и записать причину выбора в лог и метрики."""
+    logger.info(f"Plan {job.fields.get('media')}/{job.fields.get('variant')}: {plan.reason} (~{plan.saved:.1f} CPU-s saved)")
+    job.fields['plan'] = plan.reason
+    if plan.saved:
+        metrics.inc('planner_cpu_seconds_saved_total', plan.saved, kind=job.kind)
+    return plan.apply(opts)
+
+
+async def tag_audio(job, path, fmt, tags, cover, replaces_pass=False):
+    """
+    Записать теги и обложку в файл через mutagen (в пуле потоков). Ошибка тегов
+    не роняет задачу. `replaces_pass` — вместо тегов раньше был отдельный проход
+    ffmpeg (FFmpegMetadata): его оценочная стоимость за вычетом mutagen идёт в job.saved.
+    """
+    started = time.monotonic()
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, write_tags, path, fmt, tags, cover)
+    except Exception as e:
+        logger.warning(f"Cannot tag {os.path.basename(path)}: {e}")
+        return
+    seconds = time.monotonic() - started
+    job.record('tag', seconds)
+    if replaces_pass:
+        job.record_saving('tag', metadata_pass_cost(os.path.getsize(path)) - seconds)
+
+
+def staged_output(staging, ext):
+    """Итоговый файл yt-dlp в staging-папке (после постобработки меняется расширение)."""
+    return next(f for f in glob.glob(os.path.join(glob.escape(staging), 'media.*')) if f.endswith(f'.{ext}'))
+
 
+def queue_notifier(status, last_status):
+    """Колбэк планировщика: показывает позицию в очереди в статус-сообщении."""
+    def on_position(pos):
+        status_text = f"⏳ В очереди... позиция {pos}"
+        if status_text != last_status.get("text"):
+            last_status["text"] = status_text
+            progress.update(status, status_text)
+    return on_position
 
-# YoutubeDL helper
-def get_ydl(opts):
-    default = {}
-    default.update(opts)
-    return yt_dlp.YoutubeDL(default)
+
+def ydl_profile(url, video=False):
+    """Профиль YoutubeDL (см. YDL_PROFILES) для ссылки."""
+    if "yandex" in url:
+        return 'yandex'
+    return 'video' if video else 'audio'
+
+
+def get_runner():
+    """
+    Исполнитель загрузок (потоки или процессы, см. worker_mode).
+    Создаётся лениво: процессы-воркеры при spawn импортируют этот модуль и не должны плодить свои пулы.
+    """
+    global _runner
+    if _runner is None:
+        _runner = DownloadRunner(
+            WORKER_MODE, scheduler.executor, MAX_JOBS, ydl_pool=ydl_pool, bucket=bandwidth.download_bucket
+        )
+    return _runner
+
+
+async def download_media(job, opts, url, hook, profile):
+    """Скачать `url` в слоте полосы: число параллельных фрагментов зависит от текущей нагрузки."""
+    with bandwidth.download() as fragments:
+        job.fields['fragments'] = fragments
+        with job.downloading():
+            await get_runner().download(
+                dict(opts, concurrent_fragment_downloads=fragments), url, [hook, job.download_hook], profile=profile
+            )
 
 # Helper: format keyboard for video
-def format_keyboard(info):
-    kb, row, seen = [], [], set()
-    for f in sorted(info['formats'], key=lambda x: x.get('height') or 0, reverse=True):
-        height = f.get('height')
-        if not height or height in seen:
-            continue
-        seen.add(height)
+def format_keyboard(manifest):
+    kb, row = [], []
+    heights = manifest.heights()
+    sizes = {height: plan_video(manifest, height).size for height in heights}
+    # options that would exceed the upload limit are hidden; if none fits, the smallest stays and is split
+    deliverable = [h for h in heights if sizes[h] is None or sizes[h] <= MAX_UPLOAD]
+    if not deliverable and heights:
+        deliverable = [heights[-1]]
+    for height in deliverable:
         label = CATEGORY_LABELS.get(
             height, f"{height}p {'📺' if height < 720 else '🖥'}"
         )
+        if sizes[height]:
+            label += f" ~{human_size(sizes[height])}"
         row.append(InlineKeyboardButton(label, callback_data=f"video:{height}"))
         if len(row) == 2:
             kb.append(row)
@@ -180,13 +514,88 @@ def format_audio_keyboard():
             row = []
     if row:
         kb.append(row)
+    kb.append([InlineKeyboardButton("🗂 Все форматы", callback_data="audioformat:all")])
+    return InlineKeyboardMarkup(kb)
+
+# Helper: keyboard for a playlist — one choice applies to every item
+def format_batch_keyboard(audio_only):
+    kb, row = [], []
+    if not audio_only:
+        for height in (360, 720, 1080):
+            row.append(InlineKeyboardButton(CATEGORY_LABELS[height], callback_data=f"batch:video:{height}"))
+        kb.append(row)
+        row = []
+    for key, label in AUDIO_FORMATS.items():
+        row.append(InlineKeyboardButton(label, callback_data=f"batch:audio:{key}"))
+        if len(row) == 2:
+            kb.append(row)
+            row = []
+    if row:
+        kb.append(row)
     return InlineKeyboardMarkup(kb)
 
+
+def clean_title(title):
+    return ''.join(c for c in title if c.isalnum() or c in (' ', '.', '_', '-')).strip()
+
+
+def fetch_playlist(url):
+    """Плоское ленивое извлечение плейлиста: записи (генератор) подгружаются по мере перебора."""
+    ydl_opts = {
+        'quiet': True,
+        'skip_download': True,
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+    }
+    # not pooled: lazy entries keep using this instance long after the call returns
+    ydl = ydl_pool.create(ydl_profile(url), ydl_opts)
+    info = ydl.extract_info(url, download=False, process=False)
+    # some extractors answer with a redirect to the actual playlist page
+    while info.get('_type') in ('url', 'url_transparent'):
+        info = ydl.extract_info(info['url'], download=False, process=False)
+    return info
+
+
 @app.on_message(filters.command("start"))
 async def start_cmd(_, msg):
     track_user(msg.from_user.id)
     await msg.reply_text("Привет! Отправь ссылку на YouTube или Яндекс.Музыку.")
 
+@app.on_message(filters.regex(PLAYLIST_RE))
+async def handle_playlist_link(_, msg):
+    track_user(msg.from_user.id)
+    url = msg.text.strip()
+
+    job = metrics.job('extract', media=url, batch=True)
+    try:
+        with job.stage('extract'):
+            info = await asyncio.get_running_loop().run_in_executor(None, fetch_playlist, url)
+    except Exception as e:
+        job.finish('error', error=str(e))
+        logger.error(f"Error fetching playlist: {e}")
+        return await msg.reply_text(f"❌ Ошибка при получении плейлиста: {e} ❌")
+
+    title = clean_title(info.get('title') or 'playlist')
+    author = info.get('uploader') or info.get('channel') or ''
+    count = info.get('playlist_count')
+    audio_only = 'yandex' in url or 'music.youtube' in url
+    limit = f"первые {BATCH_MAX_ITEMS}" if not count or count > BATCH_MAX_ITEMS else str(count)
+    reply = await msg.reply_text(
+        f"📦 {title}{' - ' + author if author else ''}\nТреков/видео: {limit}. Выбери формат для всех:",
+        reply_markup=format_batch_keyboard(audio_only)
+    )
+
+    key = make_session_key(reply)
+    sessions.put(key, {
+        'url': url,
+        'title': title,
+        'author': author,
+        'count': count,
+        'type': 'playlist',
+        'initiator': msg.from_user.id
+    })
+    job.finish()
+
 @app.on_message(filters.regex(r"https?://(www\.)?youtu"))
 async def handle_youtube_link(_, msg):
     track_user(msg.from_user.id)
@@ -194,24 +603,16 @@ async def handle_youtube_link(_, msg):
 
     # Function to get formats
     def fetch_formats(url: str):
-        ydl_opts = {
-            'quiet': False,
-            'skip_download': True,
-            'http_headers': {
-                'User-Agent': (
-                    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                    'AppleWebKit/537.36 (KHTML, like Gecko) '
-                    'Chrome/115.0.0.0 Safari/537.36'
-                )
-            }
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl_opts = {'quiet': False, 'skip_download': True}
+        with ydl_pool.lease('video', ydl_opts) as ydl:
             return ydl.extract_info(url, download=False)
 
-    loop = asyncio.get_running_loop()
+    job = metrics.job('extract', media=canonical_id(url) or url)
     try:
-        info = await loop.run_in_executor(None, fetch_formats, url)
+        with job.stage('extract'):
+            info = await info_cache.get(url, fetch_formats)
     except Exception as e:
+        job.finish('error', error=str(e))
         logger.error(f"Error fetching formats: {e}")
         if "Sign in to confirm your age" in str(e):
             e = "видео имеет ограничения возраста"
@@ -227,25 +628,25 @@ async def handle_youtube_link(_, msg):
     ).strip()
     author = info.get('uploader','Unknown')
 
-    kb = format_keyboard(info)
+    manifest = MediaManifest.from_info(info, title, author)
+    kb = format_keyboard(manifest)
     # отправляем сообщение с клавиатурой и сохраняем сессию под ключем chat_id:message_id
     reply = await msg.reply_photo(
-        info.get('thumbnail'),
+        manifest.thumbnail,
         caption=f"{title} - {author}",
         reply_markup=kb
     )
 
-    sessions = load_sessions()
     key = make_session_key(reply)
-    sessions[key] = {
+    sessions.put(key, {
         'url': url,
-        'info': info,
+        'manifest': manifest.to_dict(),
         'title': title,
         'author': author,
         'type': 'video',
         'initiator': msg.from_user.id
-    }
-    save_sessions(sessions)
+    })
+    job.finish()
 
 @app.on_message(filters.regex(r"https?://(music\.youtube\.com|music\.yandex\.ru)"))
 async def handle_music_link(_, msg):
@@ -254,15 +655,15 @@ async def handle_music_link(_, msg):
 
     def fetch_info(url: str):
         ydl_opts = {'quiet': False, 'skip_download': True}
-        if "yandex" in url:
-            ydl_opts['cookiesfrombrowser'] = ('firefox',)
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with ydl_pool.lease(ydl_profile(url), ydl_opts) as ydl:
             return ydl.extract_info(url, download=False)
 
-    loop = asyncio.get_running_loop()
+    job = metrics.job('extract', media=canonical_id(url) or url)
     try:
-        info = await loop.run_in_executor(None, fetch_info, url)
+        with job.stage('extract'):
+            info = await info_cache.get(url, fetch_info)
     except Exception as e:
+        job.finish('error', error=str(e))
         logger.error(f"Error fetching info: {e}")
         return await msg.reply_text(f"❌ Ошибка при получении информации: {e} ❌")
 
@@ -277,304 +678,674 @@ async def handle_music_link(_, msg):
     if author in full_title:
         title = full_title.replace(author, '').strip().replace('  ', ' ').strip('- ')
 
+    manifest = MediaManifest.from_info(info, title, author)
     kb = format_audio_keyboard()
     reply = await msg.reply_text(
         f"{title} - {author}",
         reply_markup=kb
     )
 
-    sessions = load_sessions()
     key = make_session_key(reply)
-    sessions[key] = {
+    sessions.put(key, {
         'url': url,
-        'info': info,
+        'manifest': manifest.to_dict(),
         'title': title,
         'author': author,
         'type': 'audio',
         'initiator': msg.from_user.id
-    }
-    save_sessions(sessions)
+    })
+    job.finish()
+
+def move_session(key, message, sess, media_id):
+    """Перенести сессию на `message` (или просто удалить) и продлить жизнь исходной дорожки."""
+    sessions.delete(key)
+    if message is None:
+        return
+    sessions.put(make_session_key(message), sess)
+    media_cache.extend_source(media_id, SESSION_TTL)
+
+
+async def deliver_audio(cq, job, manifest, media_id, url, title, author, fmts, status, last_status,
+                        reply_markup, tags=None):
+    """
+    Отправить аудио в форматах `fmts` из одной исходной дорожки.
+
+    Источник качается один раз и хранится, пока жива сессия, поэтому другой формат
+    после «🔄 Другой формат» — это локальная конвертация, а не новая загрузка.
+    Несколько форматов конвертируются параллельно, отправляются по порядку.
+    Возвращает последнее отправленное сообщение (к нему привязана кнопка).
+    """
+    user_id = cq.from_user.id
+    # обложка качается параллельно с аудио и переиспользуется из кеша
+    thumb_task = asyncio.create_task(thumbs.get(manifest.thumbnail, media_id))
+    source_plan = plan_source(manifest)
+
+    async def download_source(hook):
+        kept = media_cache.source(media_id)
+        if kept:
+            return kept
+        staging = media_cache.staging(media_id, 'source')
+        opts = use_plan(job, source_plan, {
+            'outtmpl': os.path.join(staging, 'media.%(ext)s'),
+            'quiet': False,
+        })
+        job.begin('queue')
+        async with scheduler.slot(user_id, PRIORITY_AUDIO, queue_notifier(status, last_status)):
+            job.end('queue')
+            await download_media(job, opts, url, hook, ydl_profile(url))
+        produced = next(
+            f for f in glob.glob(os.path.join(glob.escape(staging), 'media.*')) if not f.endswith('.part')
+        )
+        return media_cache.keep_source(media_id, produced, SESSION_TTL)
+
+    def converter(fmt):
+        async def convert(hook):
+            cached = media_cache.lookup(media_id, fmt, fmt)
+            if cached:
+                return cached
+            # concurrent requests for other formats of this track share one source download
+            async with shared_downloads.join((media_id, 'source'), download_source, hook) as source:
+                best = manifest.best_audio()
+                codec = codec_family(best.acodec) if best and source.endswith('.' + (best.ext or '')) else None
+                target = os.path.join(media_cache.staging(media_id, fmt), f"media.{fmt}")
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                started = time.monotonic()
+                job.set_state('postprocessing')
+                mode = await transcoder.convert(source, codec, target, fmt)
+                job.record('transcode', time.monotonic() - started)
+            # tags and cover go into the file before it is cached, so repeat requests get them too
+            await tag_audio(job, target, fmt, tags, await thumb_task)
+            if mode == 'copy':
+                metrics.inc('planner_cpu_seconds_saved_total', copy_saving(fmt, manifest.duration), kind=job.kind)
+            return media_cache.commit(media_id, fmt, target)
+        return convert
+
+    sent = None
+    try:
+        async with AsyncExitStack() as stack:
+            # the kept source counts against the cache budget too: not evicted while formats convert from it
+            stack.enter_context(media_cache.hold(media_id, 'source'))
+            for fmt in fmts:
+                stack.enter_context(media_cache.hold(media_id, fmt))
+            results = await asyncio.gather(*(
+                stack.enter_async_context(shared_downloads.join(
+                    (media_id, fmt), converter(fmt), download_progress(status, last_status)
+                ))
+                for fmt in fmts
+            ), return_exceptions=True)
+            thumb = await thumb_task
+
+            ready = [(fmt, r) for fmt, r in zip(fmts, results) if not isinstance(r, BaseException)]
+            failed = [(fmt, r) for fmt, r in zip(fmts, results) if isinstance(r, BaseException)]
+            if failed and not ready:
+                raise failed[0][1]
+            # use rate-limited edit for the initial "sending" message
+            await safe_edit_text(status, "🚀 Отправка...")
+            for i, (fmt, path) in enumerate(ready):
+                async def send(part, suffix, last, fmt=fmt, tail=i == len(ready) - 1):
+                    return await cq.message.reply_audio(
+                        part,
+                        caption=f"{title} - {author} 🎧{suffix}",
+                        title=title + suffix,
+                        performer=author,
+                        file_name=f"{title}{suffix}.{fmt}",
+                        thumb=thumb,
+                        reply_markup=reply_markup if last and tail else None,
+                        progress=upload_progress(status, last_status)
+                    )
+
+                msg, parts = await upload_parts(path, manifest.duration, job, send)
+                if msg and msg.audio and parts == 1:
+                    file_ids.put(media_id, fmt, msg.audio.file_id)
+                sent = msg
+            for fmt, e in failed:
+                logger.error(f"Audio {media_id}/{fmt} failed: {e}")
+                await cq.message.reply_text(f"❌ {AUDIO_FORMATS.get(fmt, fmt)}: {e} ❌")
+    finally:
+        thumb_task.cancel()
+    return sent
+
 
 @app.on_callback_query()
 async def cb_handler(_, cq: CallbackQuery):
     track_user(cq.from_user.id)
-    sessions = load_sessions()
     key = make_session_key(cq.message)
 
     # поддержка старых сессий (по user_id) — опционально, но оставим как fallback
-    sess = sessions.get(key) or sessions.get(str(cq.from_user.id))
+    sess = sessions.get(key)
+    if not sess:
+        # если сессия была по user_id (фолбек), переносим её на message-ключ
+        sess = sessions.pop(str(cq.from_user.id))
+        if sess:
+            sessions.put(key, sess)
     if not sess:
         return await cq.answer("Сессия не найдена", show_alert=True)
 
-    # если сессия была по user_id (фолбек), то лучше перенести её на message-ключ, но не обязательно
-    if key not in sessions and str(cq.from_user.id) in sessions:
-        sessions[key] = sessions.pop(str(cq.from_user.id))
-        save_sessions(sessions)
-
     await cq.message.edit_reply_markup(None)
-    url = sess['url']; title = sess['title']; author = sess['author']; info = sess['info']; link_type = sess.get('type')
+    if sess.get('type') == 'playlist':
+        if job_queue is not None:
+            sessions.delete(key)
+            job_queue.submit('batch', job_payload(cq, key, sess))
+            return
+        return await run_batch(cq, sess, key)
+    url = sess['url']; title = sess['title']; author = sess['author']; manifest = MediaManifest.from_session(sess); link_type = sess.get('type')
+
+    btn_again = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Другой формат", callback_data="again")]
+    ])
+    data = cq.data
+    media_id = canonical_id(url) or manifest.video_id or url
+
+    if data == 'again':
+        # удаляем старую сессию и создаём новую для нового сообщения с клавиатурой
+        sessions.delete(key)
+
+        if link_type == 'video':
+            kb = format_keyboard(manifest)
+            new_msg = await cq.message.reply_text(f"{title} - {author}", reply_markup=kb)
+        else:
+            kb = format_audio_keyboard()
+            new_msg = await cq.message.reply_text(f"{title} - {author}", reply_markup=kb)
+
+        new_key = make_session_key(new_msg)
+        sessions.put(new_key, {
+            'url': url,
+            'manifest': manifest.to_dict(),
+            'title': title,
+            'author': author,
+            'type': link_type,
+            'initiator': sess.get('initiator')
+        })
+        return
+
+    variant = delivery_variant(data, link_type)
+    if variant is None:
+        return
+
+    # этот вариант уже отправлялся — пересылаем по file_id без скачивания
+    job = metrics.job(variant[0], variant=variant[1], media=media_id, user=cq.from_user.id)
+    formats = None
+    if variant == ('audio', 'all'):
+        # formats delivered before go out by file_id, only the rest is downloaded
+        formats, delivered = await send_cached_formats(cq.message, media_id, list(AUDIO_FORMATS), title, author, btn_again)
+    else:
+        delivered = await send_cached(cq.message, media_id, *variant, title, author, btn_again)
+    if delivered and not formats:
+        job.finish('cached')
+        move_session(key, delivered, sess, media_id)
+        return
 
     status = await cq.message.reply_text("📥 Скачивание...")
+
+    if job_queue is not None:
+        # загрузку и отправку выполнит воркер (worker.py); его job записывается там же
+        payload = job_payload(cq, key, sess)
+        payload.update({'status_id': get_msg_id(status), 'media_id': media_id})
+        if formats:
+            payload['formats'] = formats
+        job_queue.submit('delivery', payload)
+        return
+
+    await run_delivery(cq, sess, key, status, job, media_id, formats=formats)
+
+
+async def run_delivery(cq, sess, key, status, job, media_id, journal_id=None, formats=None):
+    """
+    Выполнить доставку в этом процессе. Задача записывается в журнал (journal_id —
+    при продолжении после перезапуска), этапы job отмечаются в нём же.
+    """
+    if journal is not None:
+        if journal_id is None:
+            payload = job_payload(cq, key, sess)
+            payload.update({'status_id': get_msg_id(status), 'media_id': media_id})
+            if formats:
+                payload['formats'] = formats
+            journal_id = journal.start('delivery', payload)
+        job.on_state = lambda state: journal.update(journal_id, state)
+    try:
+        delivered = await deliver(cq, sess, status, job, formats)
+    except Exception as e:
+        job.finish('error', error=str(e))
+        if journal_id is not None:
+            journal.finish(journal_id)
+        raise
+    job.finish()
+
+    # удаляем статус-уведомление
+    progress.discard(status)
+    await status.delete()
+
+    # сессия переезжает на отправленное сообщение, чтобы работала кнопка «Другой формат»
+    move_session(key, delivered, sess, media_id)
+    if journal_id is not None:
+        journal.finish(journal_id)
+
+
+async def deliver(cq, sess, status, job, formats=None):
+    """
+    Скачать и отправить вариант, выбранный кнопкой `cq.data`; возвращает последнее
+    отправленное сообщение. Вызывается из cb_handler или воркером очереди (worker.py).
+    `formats` — аудиоформаты «всех форматов», которых нет в кеше file_id (остальные уже отправлены).
+    """
+    url = sess['url']; title = sess['title']; author = sess['author']; manifest = MediaManifest.from_session(sess); link_type = sess.get('type')
+
     btn_again = InlineKeyboardMarkup([
         [InlineKeyboardButton("🔄 Другой формат", callback_data="again")]
     ])
+    data = cq.data
+    media_id = canonical_id(url) or manifest.video_id or url
 
-    loop = asyncio.get_running_loop()
     last_status = {"text": None}
-    data = cq.data
+    delivered = None
 
-    # функция загрузки используем один и тот же локальный download_hook/функции отправки
+    # все ветки используют общие хуки download_progress/upload_progress
     if data.startswith('video:') and link_type == 'video':
         res = int(data.split(':')[1])
-        out = os.path.join(DOWNLOAD_DIR, f"{title}_{res}p.mp4")
+        staging = media_cache.staging(media_id, f"{res}p")
 
-        def download_hook(d):
-            global _last_edit_ts
-            now = time.monotonic()
-            if now - _last_edit_ts < COOLDOWN_TIME:
-                return
-            status_text = None
-            if d.get('status') == 'downloading':
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                cur = d.get('downloaded_bytes', 0)
-                pct = int(cur * 100 / total) if total else 0
-                status_text = f"📥 Скачивание... {pct}%"
-            if status_text and status_text != last_status.get("text"):
-                last_status["text"] = status_text
-                _last_edit_ts = now
-                # schedule rate-limited edit
-                loop.call_soon_threadsafe(lambda st=status_text: asyncio.create_task(safe_edit_text(status, st)))
-
-        opts = {
-            'format': f"bestvideo[ext=mp4][height<={res}]+bestaudio/best",
-            'merge_output_format': 'mp4',
+        opts = use_plan(job, plan_video(manifest, res), {
             'quiet': False,
-            'outtmpl': out,
-            'progress_hooks': [download_hook],
-            'http_headers': {
-                'User-Agent': (
-                    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                    'AppleWebKit/537.36 (KHTML, like Gecko) '
-                    'Chrome/115.0.0.0 Safari/537.36'
-                )
-            }
-        }
+            'outtmpl': os.path.join(staging, 'media.mp4'),
+        })
 
-        ydl = get_ydl(opts)
-        info = ydl.extract_info(url, download=False)
-        await loop.run_in_executor(None, lambda: ydl.download([url]))
+        async def download(hook):
+            cached = media_cache.lookup(media_id, f"{res}p", 'mp4')
+            if cached:
+                return cached
+            job.begin('queue')
+            async with scheduler.slot(cq.from_user.id, PRIORITY_VIDEO, queue_notifier(status, last_status)):
+                job.end('queue')
+                await download_media(job, opts, url, hook, 'video')
+            return media_cache.commit(media_id, f"{res}p", staged_output(staging, 'mp4'))
 
         caption = f"{title} — {author}"
-        def send_progress(cur, tot):
-            pct = int(cur * 100 / tot) if tot else 0
-            status_text = f"🚀 Отправка... {pct}%"
-            if status_text != last_status["text"]:
-                last_status["text"] = status_text
-                # schedule rate-limited edit
-                loop.call_soon_threadsafe(lambda st=status_text: asyncio.create_task(safe_edit_text(status, st)))
-
-        await cq.message.reply_video(
-            out,
-            caption=caption,
-            supports_streaming=True,
-            reply_markup=btn_again,
-            progress=send_progress
-        )
-        os.remove(out)
+        # одинаковые запросы ждут одну загрузку; файл остаётся в кеше и не вытесняется до конца отправки
+        async def send(part, suffix, last):
+            return await cq.message.reply_video(
+                part,
+                caption=caption + suffix,
+                file_name=f"{title}{suffix}.mp4",
+                supports_streaming=True,
+                reply_markup=btn_again if last else None,
+                progress=upload_progress(status, last_status)
+            )
+
+        with media_cache.hold(media_id, f"{res}p"):
+            async with shared_downloads.join(
+                (media_id, f"{res}p"), download, download_progress(status, last_status)
+            ) as out:
+                sent, parts = await upload_parts(out, manifest.duration, job, send)
+        # file_id cache only for single-file deliveries
+        if sent and sent.video and parts == 1:
+            file_ids.put(media_id, f"{res}p", sent.video.file_id)
+        delivered = sent
 
     elif data.startswith('audioformat:') and link_type == 'audio':
         fmt = data.split(':')[1]
-        base = os.path.join(DOWNLOAD_DIR, title)
-        postprocessors = []
-        postprocessors.append({
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': fmt,
-            'preferredquality': '0',
-        })
-        postprocessors.append({'key': 'FFmpegMetadata'})
-
-        opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': base + '.%(ext)s',
-            'quiet': False,
-            'postprocessors': postprocessors,
-            'progress_hooks': [
-                lambda d: download_hook_shared(d, loop, status, last_status)
-            ],
-            'http_headers': {
-                'User-Agent': (
-                    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                    'AppleWebKit/537.36 (KHTML, like Gecko) '
-                    'Chrome/115.0.0.0 Safari/537.36'
-                )
-            }
-        }
-        if "yandex" in url:
-            opts['cookiesfrombrowser'] = ('firefox',)
-
-        await loop.run_in_executor(None, lambda: get_ydl(opts).download([url]))
-        audio_file = next(f for f in glob.glob(base + '.*') if f.endswith(f'.{fmt}'))
-
-        thumb = None
-        thumb_url = info.get('thumbnail') or info.get('thumbnails', [{}])[-1].get('url')
-        if thumb_url:
-            thumb = base + '.jpg'
-            r = requests.get(thumb_url, timeout=10)
-            if r.ok:
-                open(thumb, 'wb').write(r.content)
-            else:
-                thumb = None
-
-        def send_progress(cur, tot):
-            pct = int(cur * 100 / tot) if tot else 0
-            status_text = f"🚀 Отправка... {pct}%"
-            if status_text != last_status["text"]:
-                last_status["text"] = status_text
-                # schedule rate-limited edit
-                loop.call_soon_threadsafe(lambda st=status_text: asyncio.create_task(safe_edit_text(status, st)))
-
-        # use rate-limited edit for the initial "sending" message
-        await safe_edit_text(status, "🚀 Отправка...")
-        await cq.message.reply_audio(
-            audio_file,
-            caption=f"{title} - {author} 🎧",
-            title=title,
-            performer=author,
-            thumb=thumb,
-            reply_markup=btn_again,
-            progress=send_progress
+        fmts = formats or (list(AUDIO_FORMATS) if fmt == 'all' else [fmt])
+        delivered = await deliver_audio(
+            cq, job, manifest, media_id, url, title, author, fmts, status, last_status, btn_again,
+            tags={'title': title, 'artist': author}
         )
-        for f in glob.glob(base + '.*'):
-            os.remove(f)
 
     elif data == 'audio' and link_type == 'video':
-        def download_hook(d):
-            global _last_edit_ts
-            now = time.monotonic()
-            if now - _last_edit_ts < COOLDOWN_TIME:
-                return
-            status_text = None
-            if d.get('status') == 'downloading':
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                cur = d.get('downloaded_bytes', 0)
-                pct = int(cur * 100 / total) if total else 0
-                status_text = f"📥 Скачивание... {pct}%"
-            if status_text and status_text != last_status.get("text"):
-                last_status["text"] = status_text
-                _last_edit_ts = now
-                # schedule rate-limited edit
-                loop.call_soon_threadsafe(lambda st=status_text: asyncio.create_task(safe_edit_text(status, st)))
-
-        base = os.path.join(DOWNLOAD_DIR, title)
-        opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': base + '.%(ext)s',
-            'quiet': False,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'opus',
-                'preferredquality': '0',
-            }],
-            'progress_hooks': [download_hook],
-            'http_headers': {
-                'User-Agent': (
-                    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                    'AppleWebKit/537.36 (KHTML, like Gecko) '
-                    'Chrome/115.0.0.0 Safari/537.36'
-                )
-            }
-        }
-        await asyncio.get_running_loop().run_in_executor(
-            None, lambda: get_ydl(opts).download([url])
+        delivered = await deliver_audio(
+            cq, job, manifest, media_id, url, title, author, ['opus'], status, last_status, btn_again,
+            tags={'title': title, 'artist': author}
         )
-        opus_file = next(f for f in glob.glob(base + '.*') if f.endswith('.opus'))
-
-        thumb = None
-        thumb_url = info.get('thumbnail')
-        if thumb_url:
-            thumb = base + '.jpg'
-            r = requests.get(thumb_url, timeout=10)
-            if r.ok:
-                open(thumb, 'wb').write(r.content)
-            else:
-                thumb = None
-
-        def send_progress(cur, tot):
-            pct = int(cur * 100 / tot) if tot else 0
-            status_text = f"🚀 Отправка... {pct}%"
-            if status_text != last_status["text"]:
-                last_status["text"] = status_text
-                # schedule rate-limited edit
-                loop.call_soon_threadsafe(lambda st=status_text: asyncio.create_task(safe_edit_text(status, st)))
-
-        # initial update via rate-limited editor
-        await safe_edit_text(status, "🚀 Отправка...")
-        await cq.message.reply_audio(
-            opus_file,
-            caption=f"{title} - {author} 🎧",
-            title=title,
-            performer=author,
-            thumb=thumb,
-            reply_markup=btn_again,
-            progress=send_progress
-        )
-        for f in glob.glob(base + '.*'):
-            os.remove(f)
+    return delivered
+
+
+def job_payload(cq, key, sess):
+    """Всё, что нужно воркеру, чтобы выполнить нажатие кнопки без доступа к апдейту."""
+    return {
+        'chat_id': cq.message.chat.id,
+        'message_id': get_msg_id(cq.message),
+        'user_id': cq.from_user.id,
+        'data': cq.data,
+        'key': key,
+        'session': sess,
+    }
+
+
+async def apply_job_update(qjob, statuses):
+    """Перенести состояние задачи воркера в Telegram: прогресс в статус, итог — удалить статус или показать ошибку."""
+    p = qjob.payload
+    if qjob.kind != 'delivery':
+        # batch jobs keep their own status message from the worker
+        if qjob.status in ('done', 'failed'):
+            job_queue.delete(qjob.id)
+        return
+    status = statuses.get(qjob.id)
+    if status is None:
+        status = statuses[qjob.id] = await app.get_messages(p['chat_id'], p['status_id'])
+    if qjob.status in ('queued', 'running'):
+        if qjob.progress:
+            progress.update(status, qjob.progress)
+        return
 
-    elif data == 'again':
+    statuses.pop(qjob.id, None)
+    progress.discard(status)
+    if qjob.status == 'done':
         await status.delete()
-        # удаляем старую сессию и создаём новую для нового сообщения с клавиатурой
-        sessions = load_sessions()
-        sessions.pop(key, None)
+        sessions.delete(p['key'])
+        delivered = (qjob.result or {}).get('delivered')
+        if delivered:
+            sessions.put(f"{p['chat_id']}:{delivered}", p['session'])
+            media_cache.extend_source(p['media_id'], SESSION_TTL)
+    else:
+        error = (qjob.result or {}).get('error', '')
+        await status.edit_text(f"❌ Ошибка: {error} ❌")
+    job_queue.delete(qjob.id)
+
+
+async def watch_queue():
+    """
+    Фронтенд в queue_mode: забирает изменения задач и показывает их пользователям,
+    а задачи воркеров без heartbeat дольше HEARTBEAT_TIMEOUT возвращает в очередь.
+    """
+    since = 0
+    statuses = {}
+    while True:
+        try:
+            job_queue.recover(HEARTBEAT_TIMEOUT, JOB_ATTEMPTS)
+            for qjob in job_queue.changed(since):
+                since = max(since, qjob.seq)
+                try:
+                    await apply_job_update(qjob, statuses)
+                except Exception as e:
+                    logger.error(f"Cannot report job {qjob.id}: {e}")
+        except Exception as e:
+            logger.error(f"Job queue watcher failed: {e}")
+        await asyncio.sleep(QUEUE_POLL_INTERVAL)
+
+
+def batch_status_text(title, pipeline, count):
+    total = pipeline.offset + len(pipeline.items) if pipeline.exhausted else (count and min(count, BATCH_MAX_ITEMS))
+    done = pipeline.processed()
+    return (
+        f"📦 {title}: {done}/{total or '…'}\n"
+        f"📥 {pipeline.count('download')} · 🚀 {pipeline.count('upload')} · "
+        f"✅ {pipeline.count('done')} · ❌ {pipeline.count('failed')}"
+    )
 
-        if link_type == 'video':
-            kb = format_keyboard(info)
-            new_msg = await cq.message.reply_text(f"{title} - {author}", reply_markup=kb)
+
+def batch_report(title, pipeline):
+    ok = pipeline.count('done')
+    lines = [f"📦 {title}: отправлено {ok} из {len(pipeline.items)}"]
+    if pipeline.offset:
+        lines[0] += f" (ещё {pipeline.offset} — до перезапуска)"
+    if pipeline.extract_error:
+        lines.append(f"⚠️ Список получен не полностью: {pipeline.extract_error}")
+    failed = [item for item in pipeline.items if item.state == 'failed']
+    for item in failed[:20]:
+        lines.append(f"❌ {item.index}. {item.title}: {(item.error or '')[:200]}")
+    if len(failed) > 20:
+        lines.append(f"… и ещё {len(failed) - 20}")
+    return '\n'.join(lines)[:4096]
+
+
+async def run_batch(cq, sess, key, status=None, journal_id=None, skip=0):
+    """
+    Пакетная загрузка плейлиста/альбома одним выбранным форматом.
+
+    Элементы идут через BatchPipeline: пока один отправляется, следующие уже
+    скачиваются (в пределах слотов планировщика). Уже отправленные варианты
+    пересылаются по file_id, одинаковые загрузки объединяются с одиночными.
+    Число обработанных элементов пишется в журнал; после перезапуска пакет
+    продолжается с `skip` в том же статус-сообщении `status`.
+    """
+    _, kind, variant = cq.data.split(':')
+    if kind == 'video':
+        res = int(variant)
+        variant = f"{res}p"
+    url = sess['url']; title = sess['title']; author = sess['author']
+    user_id = cq.from_user.id
+    sessions.delete(key)
+
+    if status is None:
+        status = await cq.message.reply_text(f"📦 {title}: получаю список...")
+    if journal is not None and journal_id is None:
+        payload = job_payload(cq, key, sess)
+        payload['status_id'] = get_msg_id(status)
+        journal_id = journal.start('batch', payload)
+    try:
+        info = await asyncio.get_running_loop().run_in_executor(None, fetch_playlist, url)
+    except Exception as e:
+        logger.error(f"Error fetching playlist: {e}")
+        progress.discard(status)
+        if journal_id is not None:
+            journal.finish(journal_id)
+        return await status.edit_text(f"❌ Ошибка при получении плейлиста: {e} ❌")
+
+    def item_opts(item, staging):
+        opts = {'quiet': True}
+        if kind == 'video':
+            opts.update({
+                'format': (
+                    f"bestvideo[ext=mp4][height<={res}]+bestaudio[ext=m4a]"
+                    f"/best[ext=mp4][height<={res}]/best[height<={res}]"
+                ),
+                'merge_output_format': 'mp4',
+                'outtmpl': os.path.join(staging, 'media.mp4'),
+            })
         else:
-            kb = format_audio_keyboard()
-            new_msg = await cq.message.reply_text(f"{title} - {author}", reply_markup=kb)
+            opts.update({
+                'format': 'bestaudio/best',
+                'outtmpl': os.path.join(staging, 'media.%(ext)s'),
+                'postprocessors': [
+                    {'key': 'FFmpegExtractAudio', 'preferredcodec': variant, 'preferredquality': '0'},
+                ],
+            })
+        return opts
+
+    ext = 'mp4' if kind == 'video' else variant
+
+    async def fetch(item):
+        item.media_id = canonical_id(item.url) or item.url
+        item.job = metrics.job(kind, variant=variant, media=item.media_id, user=user_id, batch=True)
+        item.file_id = file_ids.get(item.media_id, variant)
+        if item.file_id:
+            return None
+        return await download_item(item)
+
+    async def download_item(item):
+        staging = media_cache.staging(item.media_id, variant)
+        opts = item_opts(item, staging)
+        cover_task = None
+        if kind == 'audio':
+            # the cover is fetched while the track downloads
+            cover_task = asyncio.create_task(thumbs.get(pick_thumbnail(item.entry), item.media_id))
+
+        async def download(hook):
+            cached = media_cache.lookup(item.media_id, variant, ext)
+            if cached:
+                return cached
+            item.job.begin('queue')
+            async with scheduler.slot(user_id, PRIORITY_AUDIO if kind == 'audio' else PRIORITY_VIDEO):
+                item.job.end('queue')
+                await download_media(item.job, opts, item.url, hook, ydl_profile(item.url, kind == 'video'))
+            output = staged_output(staging, ext)
+            if kind == 'audio':
+                # replaces the FFmpegMetadata pass: tags and cover are written in place
+                tags = {
+                    'title': item.entry.get('title') or item.title,
+                    'artist': item.entry.get('uploader') or item.entry.get('channel') or author,
+                }
+                await tag_audio(item.job, output, variant, tags, await cover_task, replaces_pass=True)
+            return media_cache.commit(item.media_id, variant, output)
+
+        # the cached file is held until release(), so it is not evicted before the upload
+        item.hold = AsyncExitStack()
+        try:
+            item.hold.enter_context(media_cache.hold(item.media_id, variant))
+            return await item.hold.enter_async_context(
+                shared_downloads.join((item.media_id, variant), download)
+            )
+        except BaseException as e:
+            # release() runs only for fetched items: a failed or cancelled fetch drops its hold here
+            await item.hold.aclose()
+            if isinstance(e, Exception):
+                item.job.finish('error', error=str(e))
+            raise
+
+    async def deliver(item, path):
+        caption_title = item.entry.get('title') or item.title
+        performer = item.entry.get('uploader') or item.entry.get('channel') or author
+        if path is None:
+            if await send_cached(cq.message, item.media_id, kind, variant, caption_title, performer, None, item.file_id):
+                item.job.finish('cached')
+                return
+            # send_cached dropped the stale file_id: download as if it was never sent
+            path = await download_item(item)
+        async def send(part, suffix, last):
+            if kind == 'video':
+                return await cq.message.reply_video(
+                    part, caption=f"{caption_title} — {performer}{suffix}",
+                    file_name=f"{clean_title(caption_title)}{suffix}.mp4", supports_streaming=True,
+                    progress=bandwidth.upload_throttle()
+                )
+            return await cq.message.reply_audio(
+                part, caption=f"{caption_title} - {performer} 🎧{suffix}", title=caption_title + suffix,
+                performer=performer, file_name=f"{clean_title(caption_title)}{suffix}.{ext}",
+                progress=bandwidth.upload_throttle()
+            )
 
-        new_key = make_session_key(new_msg)
-        sessions[new_key] = {
-            'url': url,
-            'info': info,
-            'title': title,
-            'author': author,
-            'type': link_type,
-            'initiator': sess.get('initiator')
+        try:
+            sent, parts = await upload_parts(path, item.entry.get('duration'), item.job, send)
+        except Exception as e:
+            item.job.finish('error', error=str(e))
+            raise
+        media = (sent.video if kind == 'video' else sent.audio) if sent else None
+        if media and parts == 1:
+            file_ids.put(item.media_id, variant, media.file_id)
+        item.job.finish()
+
+    async def release(item, path):
+        if item.hold is not None:
+            await item.hold.aclose()
+
+    journaled = {}
+
+    def on_change(p):
+        progress.update(status, batch_status_text(title, p, sess.get('count')))
+        if journal_id is None:
+            return
+        # items in flight keep their partial downloads on restart, see prune_orphans()
+        state = {
+            'done': p.processed(),
+            'active': [[item.media_id, variant] for item in p.items if item.media_id and item.state == 'download'],
         }
-        save_sessions(sessions)
-        return
+        if state != journaled:
+            journaled.update(state)
+            journal.update(journal_id, 'downloading', state)
+
+    pipeline = BatchPipeline(
+        lazy_entries(info.get('entries'), BATCH_MAX_ITEMS, skip), fetch, deliver, release,
+        prefetch=BATCH_PREFETCH, on_change=on_change, offset=skip,
+    )
+    await pipeline.run()
+
+    progress.discard(status)
+    await status.edit_text(batch_report(title, pipeline))
+    if journal_id is not None:
+        journal.finish(journal_id)
+
+
+async def warm_ydl_pool():
+    seconds = await asyncio.get_running_loop().run_in_executor(None, ydl_pool.warm)
+    logger.info(
+        f"YoutubeDL pool ready in {seconds:.2f}s "
+        f"(yt_dlp import {ydl_pool.import_seconds or 0:.2f}s, {ydl_pool.built} profiles)"
+    )
 
-    # удаляем статус-уведомление
-    await status.delete()
 
-    # очистка сессии по этому сообщению — больше не нужна
+async def restore_callback(client, payload):
+    """Нажатие кнопки из записи задачи (job_payload): для воркера очереди и продолжения после перезапуска."""
+    message = await client.get_messages(payload['chat_id'], payload['message_id'])
+    if getattr(message, 'empty', False):
+        raise RuntimeError("message with the keyboard was deleted")
+    return SimpleNamespace(message=message, from_user=SimpleNamespace(id=payload['user_id']), data=payload['data'])
+
+
+def journal_staging(entry):
+    """(id ролика, вариант) staging-папок, с частичных файлов которых продолжится задача журнала."""
+    p = entry.payload
+    if entry.kind == 'batch':
+        return [tuple(pair) for pair in entry.progress.get('active', [])]
+    kind, variant = delivery_variant(p['data'], p['session'].get('type')) or (None, None)
+    if kind == 'video':
+        return [(p['media_id'], variant)]
+    if kind == 'audio':
+        fmts = p.get('formats') or (list(AUDIO_FORMATS) if variant == 'all' else [variant])
+        return [(p['media_id'], 'source')] + [(p['media_id'], fmt) for fmt in fmts]
+    return []
+
+
+async def resume_job(entry):
+    """Продолжить задачу, прерванную перезапуском, в её статус-сообщении."""
+    p = entry.payload
     try:
-        sessions = load_sessions()
-        sessions.pop(key, None)
-        save_sessions(sessions)
-    except Exception:
-        pass
-
-# Shared download hook for audio formats
-def download_hook_shared(d, loop, status, last_status):
-    global _last_edit_ts
-    now = time.monotonic()
-    if now - _last_edit_ts < COOLDOWN_TIME:
+        cq = await restore_callback(app, p)
+        status = await app.get_messages(p['chat_id'], p['status_id'])
+        if getattr(status, 'empty', False):
+            raise RuntimeError("status message was deleted")
+    except Exception as e:
+        logger.error(f"Cannot resume job {entry.id}: {e}")
+        journal.finish(entry.id)
         return
-    status_text = None
-    if d.get('status') == 'downloading':
-        total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-        cur = d.get('downloaded_bytes', 0)
-        pct = int(cur * 100 / total) if total else 0
-        status_text = f"📥 Скачивание... {pct}%"
-    if status_text and status_text != last_status.get("text"):
-        last_status["text"] = status_text
-        _last_edit_ts = now
-        # schedule rate-limited edit
-        loop.call_soon_threadsafe(lambda st=status_text: asyncio.create_task(safe_edit_text(status, st)))
+    # counted before the job runs: a job that takes the process down is not resumed forever
+    attempts = journal.resume(entry.id)
+    if attempts > JOB_ATTEMPTS:
+        logger.error(f"Job {entry.id} was interrupted {attempts - 1} times, giving up")
+        journal.finish(entry.id)
+        progress.discard(status)
+        await status.edit_text("❌ Ошибка: задача прерывалась несколько раз подряд, попробуй ещё раз позже ❌")
+        return
+    logger.info(f"Resuming {entry.kind} job {entry.id} interrupted while {entry.state} (attempt {attempts})")
+    if entry.kind == 'batch':
+        return await run_batch(cq, p['session'], p['key'], status, entry.id, entry.progress.get('done', 0))
+
+    progress.update(status, "🔄 Продолжаю после перезапуска...")
+    kind, variant = delivery_variant(p['data'], p['session'].get('type'))
+    job = metrics.job(kind, variant=variant, media=p['media_id'], user=p['user_id'], resumed=True)
+    try:
+        await run_delivery(cq, p['session'], p['key'], status, job, p['media_id'], entry.id, p.get('formats'))
+    except Exception as e:
+        logger.error(f"Resumed job {entry.id} failed: {e}")
+        progress.discard(status)
+        await status.edit_text(f"❌ Ошибка: {e} ❌")
+
+
+async def main():
+    global cold_start
+    resumable = []
+    if journal is not None:
+        # partial downloads of interrupted jobs are kept, everything else in staging is an orphan
+        resumable = journal.unfinished()
+        media_cache.prune_staging([pair for entry in resumable for pair in journal_staging(entry)])
+    await app.start()
+    cold_start = time.perf_counter() - STARTED_AT
+    logger.info(f"Bot connected in {cold_start:.2f}s")
+    # yt_dlp and one YoutubeDL per profile are prepared in the background, /start is answered meanwhile
+    asyncio.create_task(warm_ydl_pool())
+    if METRICS_PORT:
+        await metrics.serve(METRICS_PORT)
+    if METRICS_FILE:
+        asyncio.create_task(metrics.write_periodically(os.path.join(BASE_DIR, METRICS_FILE)))
+    if job_queue is not None:
+        asyncio.create_task(watch_queue())
+    for entry in resumable:
+        asyncio.create_task(resume_job(entry))
+    await idle()
+    await app.stop()
 
 
 if __name__ == '__main__':
-    app.run()
+    try:
+        app.run(main())
+    finally:
+        users.flush()
+        if _runner is not None:
+            _runner.shutdown()
+        ydl_pool.close()
@@ -0,0 +1,168 @@
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Cover formats Telegram thumbnails and audio tags accept; YouTube's `thumbnail` is usually webp
+COVER_EXTS = ('.jpg', '.jpeg', '.png')
+
+
+def _codec(value):
+    # yt-dlp uses 'none' for a missing stream and None for unknown
+    if not value or value == 'none':
+        return None
+    return value
+
+
+def pick_thumbnail(info):
+    """
+    Обложка из info dict (или плоской записи плейлиста) yt-dlp: лучшая JPEG/PNG
+    из `thumbnails` (они идут от худшей к лучшей), иначе `thumbnail` как есть.
+    """
+    thumbnails = info.get('thumbnails') or []
+    for thumb in reversed(thumbnails):
+        url = thumb.get('url') or ''
+        if urlsplit(url).path.lower().endswith(COVER_EXTS):
+            return url
+    return info.get('thumbnail') or (thumbnails[-1].get('url') if thumbnails else None)
+
+
+class FormatEntry:
+    """Один формат из extract_info: только то, что нужно для выбора и оценки размера."""
+
+    __slots__ = ('format_id', 'height', 'ext', 'vcodec', 'acodec', 'size', 'tbr')
+
+    def __init__(self, format_id, height=None, ext=None, vcodec=None, acodec=None, size=None, tbr=None):
+        self.format_id = format_id
+        self.height = height
+        self.ext = ext
+        self.vcodec = vcodec
+        self.acodec = acodec
+        self.size = size
+        self.tbr = tbr
+
+    @property
+    def has_video(self):
+        return self.vcodec is not None
+
+    @property
+    def has_audio(self):
+        return self.acodec is not None
+
+    @property
+    def progressive(self):
+        return self.has_video and self.has_audio
+
+    def to_list(self):
+        return [self.format_id, self.height, self.ext, self.vcodec, self.acodec, self.size, self.tbr]
+
+    @classmethod
+    def from_list(cls, row):
+        return cls(*row)
+
+    @classmethod
+    def from_ydl(cls, f, duration=None):
+        size = f.get('filesize') or f.get('filesize_approx')
+        tbr = f.get('tbr')
+        if not size and tbr and duration:
+            # tbr is in KBit/s
+            size = int(tbr * 1000 / 8 * duration)
+        return cls(
+            str(f.get('format_id')),
+            f.get('height'),
+            f.get('ext'),
+            _codec(f.get('vcodec')),
+            _codec(f.get('acodec')),
+            int(size) if size else None,
+            tbr,
+        )
+
+
+class MediaManifest:
+    """
+    Компактное описание ролика/трека для сессии вместо полного info dict.
+
+    Хранит id, название, автора, обложку и по одному лучшему формату на каждую
+    комбинацию (высота, контейнер, кодеки), поэтому размер не зависит от числа
+    фрагментов, субтитров и миниатюр у исходного видео.
+    """
+
+    __slots__ = ('video_id', 'title', 'author', 'thumbnail', 'duration', 'formats')
+
+    def __init__(self, video_id, title, author, thumbnail=None, duration=None, formats=None):
+        self.video_id = video_id
+        self.title = title
+        self.author = author
+        self.thumbnail = thumbnail
+        self.duration = duration
+        self.formats = formats or []
+
+    @classmethod
+    def from_info(cls, info, title=None, author=None):
+        duration = info.get('duration')
+        best = {}
+        for f in info.get('formats') or []:
+            entry = FormatEntry.from_ydl(f, duration)
+            if not entry.has_video and not entry.has_audio:
+                # storyboards, manifests without codec info
+                continue
+            group = (entry.height, entry.ext, entry.vcodec, entry.acodec)
+            cur = best.get(group)
+            if cur is None or (entry.tbr or 0) > (cur.tbr or 0):
+                best[group] = entry
+        return cls(
+            info.get('id'),
+            title if title is not None else info.get('title', ''),
+            author if author is not None else info.get('uploader', 'Unknown'),
+            pick_thumbnail(info),
+            duration,
+            list(best.values()),
+        )
+
+    @classmethod
+    def from_session(cls, sess):
+        # sessions created before manifests existed still carry the full info dict
+        if 'manifest' in sess:
+            return cls.from_dict(sess['manifest'])
+        return cls.from_info(sess.get('info') or {}, sess.get('title'), sess.get('author'))
+
+    def to_dict(self):
+        return {
+            'id': self.video_id,
+            'title': self.title,
+            'author': self.author,
+            'thumbnail': self.thumbnail,
+            'duration': self.duration,
+            'formats': [f.to_list() for f in self.formats],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get('id'),
+            data.get('title', ''),
+            data.get('author', 'Unknown'),
+            data.get('thumbnail'),
+            data.get('duration'),
+            [FormatEntry.from_list(row) for row in data.get('formats', [])],
+        )
+
+    def heights(self):
+        """Доступные высоты видео по убыванию."""
+        return sorted({f.height for f in self.formats if f.has_video and f.height}, reverse=True)
+
+    def best_audio(self):
+        audio = [f for f in self.formats if f.has_audio and not f.has_video]
+        if not audio:
+            return None
+        return max(audio, key=lambda f: f.tbr or 0)
+
+    def best_video(self, res, ext='mp4'):
+        video = [
+            f for f in self.formats
+            if f.has_video and not f.has_audio and f.height and f.height <= res
+            and (ext is None or f.ext == ext)
+        ]
+        if not video:
+            return None
+        return max(video, key=lambda f: (f.height, f.tbr or 0))
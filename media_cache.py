@@ -0,0 +1,277 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+STAGING = '.staging'
+SOURCES = '.sources'
+# Hold markers, one per (variant, process): queue workers share DOWNLOAD_DIR but not each other's _refs
+HOLDS = '.holds'
+# Unfinished downloads are kept for resume (yt-dlp continues .part files), but not forever
+STAGING_MAX_AGE = 24 * 3600
+# Extensions of the files the old title-based layout left in DOWNLOAD_DIR
+LEGACY_MEDIA_EXTS = {'mp4', 'mkv', 'webm', 'm4a', 'mp3', 'opus', 'ogg', 'flac', 'wav', 'part', 'ytdl'}
+HEX_DIGITS = set('0123456789abcdef')
+
+
+class MediaCache:
+    """
+    Контентно-адресуемый кеш готовых файлов в DOWNLOAD_DIR.
+
+    Файл называется по sha1 от (id ролика, вариант), поэтому одинаковые названия
+    разных роликов не конфликтуют. Загрузка идёт в отдельную staging-папку и
+    атомарно переносится в кеш по завершении, так что в кеше не бывает
+    недокачанных файлов. Размер ограничен `max_bytes`, вытесняются давно не
+    использованные файлы (LRU по mtime), кроме тех, что сейчас удерживаются hold().
+
+    Исходные аудиодорожки для локальной конвертации хранятся отдельно, в .sources:
+    они живут, пока жива сессия (срок хранится в mtime файла), но входят в тот же
+    `max_bytes` и вытесняются наравне с готовыми файлами по последнему использованию.
+
+    Папку могут делить несколько процессов (воркеры queue_mode): у каждого свой
+    индекс, а удерживаемые варианты отмечаются файлами в .holds, поэтому один
+    процесс не вытесняет файл, который отправляет другой. Процесс с `owner`
+    качает в свою папку .staging/<owner>, чтобы два воркера с одним и тем же
+    роликом не писали в одну staging-папку; lookup() при промахе индекса
+    проверяет диск, так что файл, готовый у другого процесса, не качается заново.
+    """
+
+    def __init__(self, directory, max_bytes, owner=None):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.owner = owner
+        self._entries = {}
+        self._refs = {}
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.join(directory, STAGING), exist_ok=True)
+        os.makedirs(os.path.join(directory, SOURCES), exist_ok=True)
+        os.makedirs(os.path.join(directory, HOLDS), exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # rebuild the index from disk: {filename: [size, last_used]}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                name = entry.name
+                stem, _, ext = name.partition('.')
+                if len(stem) != 40 or not set(stem) <= HEX_DIGITS:
+                    # download_dir may point at a directory with other files: only old-layout media is removed
+                    if ext.rpartition('.')[2].lower() in LEGACY_MEDIA_EXTS:
+                        self._remove(entry.path)
+                    continue
+                st = entry.stat()
+                self._track(name, st.st_size, st.st_mtime)
+        now = time.time()
+        with os.scandir(os.path.join(self.directory, SOURCES)) as it:
+            for entry in it:
+                st = entry.stat()
+                if st.st_mtime >= now:
+                    # mtime is the deadline; ctime is when keep_source/extend_source last set it
+                    self._track(os.path.join(SOURCES, entry.name), st.st_size, st.st_ctime)
+        staging = os.path.join(self.directory, STAGING)
+        with os.scandir(staging) as it:
+            for entry in it:
+                try:
+                    if now - entry.stat().st_mtime > STAGING_MAX_AGE:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                except OSError:
+                    pass
+        # markers of processes that died while holding a file
+        with os.scandir(os.path.join(self.directory, HOLDS)) as it:
+            for entry in it:
+                try:
+                    if now - entry.stat().st_mtime > STAGING_MAX_AGE:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+        self._sweep_sources()
+        self._evict()
+
+    @staticmethod
+    def _digest(media_id, variant):
+        return hashlib.sha1(f"{media_id}/{variant}".encode('utf-8')).hexdigest()
+
+    def _name(self, media_id, variant, ext):
+        return f"{self._digest(media_id, variant)}.{ext}"
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def lookup(self, media_id, variant, ext):
+        """Путь к готовому файлу или None."""
+        name = self._name(media_id, variant, ext)
+        entry = self._entries.get(name)
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            if entry is not None:
+                self._forget(name)
+            self.misses += 1
+            return None
+        if entry is None:
+            # committed by another process sharing the directory
+            self._track(name, os.path.getsize(path))
+            entry = self._entries[name]
+        entry[1] = time.time()
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return path
+
+    def staging(self, media_id, variant):
+        """Папка для загрузки варианта (создаёт yt-dlp); сохраняется между попытками, чтобы докачка продолжалась."""
+        if self.owner:
+            return os.path.join(self.directory, STAGING, self.owner, self._digest(media_id, variant))
+        return os.path.join(self.directory, STAGING, self._digest(media_id, variant))
+
+    def prune_staging(self, live):
+        """
+        Удалить из staging всё, что не относится к живым задачам `live` ((id ролика, вариант)):
+        недокачанные файлы задач, которые уже не продолжатся, и временные папки нарезки.
+        """
+        keep = {self._digest(media_id, variant) for media_id, variant in live}
+        removed = 0
+        with os.scandir(os.path.join(self.directory, STAGING)) as it:
+            for entry in it:
+                if entry.name in keep:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    self._remove(entry.path)
+                removed += 1
+        if removed:
+            logger.info(f"Removed {removed} orphaned staging entries, kept {len(keep)} for resumed jobs")
+        return removed
+
+    def commit(self, media_id, variant, produced):
+        """Атомарно перенести готовый файл из staging в кеш и вернуть его новый путь."""
+        ext = os.path.splitext(produced)[1].lstrip('.')
+        name = self._name(media_id, variant, ext)
+        path = os.path.join(self.directory, name)
+        os.replace(produced, path)
+        shutil.rmtree(os.path.dirname(produced), ignore_errors=True)
+        self._track(name, os.path.getsize(path))
+        self._evict()
+        return path
+
+    def _source_path(self, media_id):
+        prefix = os.path.join(self.directory, SOURCES, self._digest(media_id, 'source'))
+        with os.scandir(os.path.dirname(prefix)) as it:
+            for entry in it:
+                if entry.path.startswith(prefix + '.'):
+                    return entry.path
+        return None
+
+    def source(self, media_id):
+        """Сохранённая исходная дорожка или None, если её нет или срок сессии истёк."""
+        path = self._source_path(media_id)
+        if path is None:
+            return None
+        if os.path.getmtime(path) < time.time():
+            self._remove(path)
+            self._forget(os.path.join(SOURCES, os.path.basename(path)))
+            return None
+        self._track(os.path.join(SOURCES, os.path.basename(path)), os.path.getsize(path))
+        return path
+
+    def keep_source(self, media_id, produced, ttl):
+        """Перенести скачанную исходную дорожку в .sources и хранить её `ttl` секунд."""
+        name = self._digest(media_id, 'source') + os.path.splitext(produced)[1]
+        path = os.path.join(self.directory, SOURCES, name)
+        os.replace(produced, path)
+        shutil.rmtree(os.path.dirname(produced), ignore_errors=True)
+        self.extend_source(media_id, ttl)
+        self._track(os.path.join(SOURCES, name), os.path.getsize(path))
+        self._sweep_sources()
+        self._evict()
+        return path
+
+    def extend_source(self, media_id, ttl):
+        """Продлить хранение исходной дорожки (сессия перешла на новое сообщение)."""
+        path = self._source_path(media_id)
+        if path is not None:
+            deadline = time.time() + ttl
+            os.utime(path, (deadline, deadline))
+            entry = self._entries.get(os.path.join(SOURCES, os.path.basename(path)))
+            if entry is not None:
+                entry[1] = time.time()
+
+    def _sweep_sources(self):
+        now = time.time()
+        with os.scandir(os.path.join(self.directory, SOURCES)) as it:
+            for entry in it:
+                try:
+                    if entry.stat().st_mtime < now:
+                        os.remove(entry.path)
+                        self._forget(os.path.join(SOURCES, entry.name))
+                except OSError:
+                    pass
+
+    @contextmanager
+    def hold(self, media_id, variant):
+        """Пока блок активен, файлы варианта не вытесняются (идёт загрузка или отправка)."""
+        digest = self._digest(media_id, variant)
+        marker = os.path.join(self.directory, HOLDS, f"{digest}.{os.getpid()}")
+        if digest not in self._refs:
+            open(marker, 'wb').close()
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+        try:
+            yield
+        finally:
+            refs = self._refs[digest] - 1
+            if refs:
+                self._refs[digest] = refs
+            else:
+                del self._refs[digest]
+                self._remove(marker)
+                self._evict()
+
+    def _held(self):
+        """Варианты, удерживаемые этим или другими процессами."""
+        held = set(self._refs)
+        with os.scandir(os.path.join(self.directory, HOLDS)) as it:
+            held.update(entry.name.partition('.')[0] for entry in it)
+        return held
+
+    def _track(self, name, size, used=None):
+        # name is relative to the cache directory: sources are indexed as .sources/<file>
+        old = self._entries.get(name)
+        if old is not None:
+            self.total -= old[0]
+        self._entries[name] = [size, time.time() if used is None else used]
+        self.total += size
+
+    def _forget(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.total -= entry[0]
+
+    def _evict(self):
+        if self.total <= self.max_bytes:
+            return
+        held = self._held()
+        for name, _ in sorted(self._entries.items(), key=lambda kv: kv[1][1]):
+            if self.total <= self.max_bytes:
+                break
+            if os.path.basename(name).partition('.')[0] in held:
+                continue
+            self._remove(os.path.join(self.directory, name))
+            self._forget(name)
+            self.evictions += 1
+        if self.total > self.max_bytes:
+            logger.warning(f"Media cache over limit: {self.total} bytes held by active jobs")
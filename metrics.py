@@ -0,0 +1,252 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'quixsaver'
+# Stage durations range from sub-second extractions to multi-minute 4K merges
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# Job state (see journal.py) entered when a stage begins
+STAGE_STATES = {'queue': 'queued', 'split': 'postprocessing', 'transcode': 'postprocessing', 'upload': 'uploading'}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    inner = ','.join(f'{k}="{str(v)}"' for k, v in sorted(labels))
+    return '{' + inner + '}'
+
+
+class Metrics:
+    """
+    Минимальный реестр метрик в формате Prometheus: счётчики, гистограммы
+    длительностей этапов и гейджи, значение которых берётся в момент выгрузки.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = [[0] * len(STAGE_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(STAGE_BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def gauge(self, name, fn, text=None):
+        """Зарегистрировать гейдж; `fn()` вызывается при каждой выгрузке."""
+        self._gauges[name] = fn
+        if text:
+            self._help[name] = text
+
+    def render(self):
+        """Текст всех метрик в формате Prometheus exposition."""
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {PREFIX}_{name} {self._help[name]}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, 'counter')
+                for key, value in series.items():
+                    lines.append(f"{PREFIX}_{name}{_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                header(name, 'histogram')
+                for key, (buckets, total, count) in series.items():
+                    for bound, n in zip(STAGE_BUCKETS, buckets):
+                        lines.append(f"{PREFIX}_{name}_bucket{_labels(key + (('le', bound),))} {n}")
+                    lines.append(f"{PREFIX}_{name}_bucket{_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{PREFIX}_{name}_sum{_labels(key)} {total:.6f}")
+                    lines.append(f"{PREFIX}_{name}_count{_labels(key)} {count}")
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                logger.error(f"Gauge {name} failed: {e}")
+                continue
+            header(name, 'gauge')
+            lines.append(f"{PREFIX}_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def job(self, kind, **fields):
+        return Job(self, kind, fields)
+
+    async def serve(self, port, host='127.0.0.1'):
+        """HTTP-эндпоинт с метриками: любой GET на host:port отдаёт render()."""
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b'\r\n\r\n')
+                body = self.render().encode('utf-8')
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                    b"Connection: close\r\n\r\n" + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError):
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f"Metrics served on http://{host}:{port}/metrics")
+        return server
+
+    async def write_periodically(self, path, interval=15.0):
+        """Периодически атомарно записывать метрики в файл (для node_exporter textfile)."""
+        while True:
+            tmp = path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(self.render())
+            os.replace(tmp, path)
+            await asyncio.sleep(interval)
+
+
+class Job:
+    """
+    Таймеры и счётчики байт одной задачи.
+
+    Этапы: queue, extract, download, transcode, tag, upload. Разделение download/transcode
+    делается по последнему событию 'finished' от yt-dlp: всё после него —
+    постобработка (слияние, перекодирование). finish() пишет итоговую строку в лог
+    вместе со скоростью скачивания и отправки (по ней подбираются бюджеты полосы).
+    Смена состояния (queued, downloading, ...) передаётся в `on_state`, если он задан.
+    """
+
+    def __init__(self, metrics, kind, fields):
+        self.metrics = metrics
+        self.kind = kind
+        self.fields = fields
+        self.created = time.monotonic()
+        self.stages = {}
+        self.bytes = {}
+        self.saved = {}
+        self._started = {}
+        self._dl_finished = None
+        self._dl_bytes = 0
+        self._done = False
+        self.state = None
+        self.on_state = None
+
+    def set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        if self.on_state is not None:
+            try:
+                self.on_state(state)
+            except Exception as e:
+                logger.error(f"Job state callback failed: {e}")
+
+    def record(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.metrics.observe('stage_seconds', seconds, stage=stage, kind=self.kind)
+
+    def record_saving(self, stage, seconds):
+        """Оценка времени, которое этап `stage` сэкономил по сравнению с прежним способом."""
+        if seconds <= 0:
+            return
+        self.saved[stage] = self.saved.get(stage, 0.0) + seconds
+        self.metrics.inc('stage_seconds_saved_total', seconds, stage=stage, kind=self.kind)
+
+    def add_bytes(self, stage, n):
+        if not n:
+            return
+        self.bytes[stage] = self.bytes.get(stage, 0) + n
+        self.metrics.inc('stage_bytes_total', n, stage=stage, kind=self.kind)
+
+    def begin(self, stage):
+        self._started[stage] = time.monotonic()
+        if stage in STAGE_STATES:
+            self.set_state(STAGE_STATES[stage])
+
+    def end(self, stage):
+        started = self._started.pop(stage, None)
+        if started is not None:
+            self.record(stage, time.monotonic() - started)
+
+    @contextmanager
+    def stage(self, stage):
+        self.begin(stage)
+        try:
+            yield
+        finally:
+            self.end(stage)
+
+    def download_hook(self, d):
+        # runs in download threads / progress pump
+        if d.get('status') == 'finished':
+            self._dl_finished = time.monotonic()
+            self._dl_bytes += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+
+    @contextmanager
+    def downloading(self):
+        """Обернуть вызов yt-dlp: время делится на download и transcode."""
+        started = time.monotonic()
+        self._dl_finished = None
+        self.set_state('downloading')
+        try:
+            yield
+        finally:
+            ended = time.monotonic()
+            finished = self._dl_finished or ended
+            self.record('download', finished - started)
+            if ended > finished:
+                self.record('transcode', ended - finished)
+            self.add_bytes('download', self._dl_bytes)
+            self._dl_bytes = 0
+
+    def throughput(self):
+        """Средняя скорость этапов с учётом байт (download, upload) в Мбит/с."""
+        return {
+            stage: round(n * 8 / self.stages[stage] / 1e6, 2)
+            for stage, n in self.bytes.items() if self.stages.get(stage)
+        }
+
+    def finish(self, status='ok', **extra):
+        if self._done:
+            return
+        self._done = True
+        total = time.monotonic() - self.created
+        self.metrics.inc('jobs_total', kind=self.kind, status=status)
+        self.metrics.observe('job_seconds', total, kind=self.kind)
+        line = {
+            'kind': self.kind,
+            'status': status,
+            'total': round(total, 3),
+            'stages': {k: round(v, 3) for k, v in self.stages.items()},
+            'saved': {k: round(v, 3) for k, v in self.saved.items()},
+            'bytes': self.bytes,
+            'mbps': self.throughput(),
+        }
+        line.update(self.fields)
+        line.update(extra)
+        logger.info("job " + json.dumps(line, ensure_ascii=False, default=str))
@@ -1,16 +1,116 @@
 import os
 import json
+import time
 import asyncio
+import hashlib
 from pyrogram import Client
+from pyrogram.errors import (
+    FloodWait, UserIsBlocked, InputUserDeactivated, PeerIdInvalid, UserDeactivated, UserDeactivatedBan
+)
 from dotenv import load_dotenv
 
+from users import iter_users, UserRegistry
+from progress import TokenBucket
+
 load_dotenv(override=True)
 API_ID = int(os.getenv("API_ID", 0))
 API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-USERS_FILE = os.path.join(BASE_DIR, "users.json")
+with open(os.path.join(BASE_DIR, "config.json"), 'r', encoding='utf-8') as f:
+    _cfg = json.load(f)
+USERS_FILE = os.path.join(BASE_DIR, _cfg.get('users_file', "users.json"))
+USERS_LOG = os.path.join(BASE_DIR, _cfg.get('users_log', "users.log"))
 MESSAGE_FILE = os.path.join(BASE_DIR, "mass_sent.txt")
+CHECKPOINT_FILE = os.path.join(BASE_DIR, "mass_sent.checkpoint")
+# Telegram allows roughly 30 messages per second to different users for bots
+BROADCAST_RATE = float(_cfg.get('broadcast_rate', 25))
+BROADCAST_CONCURRENCY = int(_cfg.get('broadcast_concurrency', 20))
+REPORT_INTERVAL = 5
+
+# Errors after which the user will never receive messages from the bot again
+DEAD_USER_ERRORS = (UserIsBlocked, InputUserDeactivated, PeerIdInvalid, UserDeactivated, UserDeactivatedBan)
+
+
+class Checkpoint:
+    """
+    Журнал рассылки: строка `<uid>\\t<статус>` на каждого обработанного пользователя.
+    Первая строка — хеш сообщения, чтобы новая рассылка не продолжала старую.
+    """
+
+    def __init__(self, path, message):
+        self.path = path
+        self.digest = hashlib.sha1(message.encode('utf-8')).hexdigest()
+        self.done = {}
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                if f.readline().strip() == self.digest:
+                    for line in f:
+                        uid, _, status = line.strip().partition('\t')
+                        if uid:
+                            self.done[int(uid)] = status
+        if self.done:
+            self._file = open(path, 'a', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+            self._file.write(self.digest + '\n')
+            self._file.flush()
+
+    def should_send(self, uid):
+        # transient failures are retried on resume
+        return self.done.get(uid) not in ('delivered', 'blocked')
+
+    def record(self, uid, status):
+        self.done[uid] = status
+        self._file.write(f"{uid}\t{status}\n")
+        self._file.flush()
+
+    def blocked(self):
+        return [uid for uid, status in self.done.items() if status == 'blocked']
+
+    def close(self):
+        self._file.close()
+
+
+async def _acquire(bucket):
+    while True:
+        delay = bucket.delay(time.monotonic())
+        if delay <= 0:
+            bucket.take(time.monotonic())
+            return
+        await asyncio.sleep(delay)
+
+
+async def _send(app, uid, message, bucket):
+    """Отправить одному пользователю, пережидая FloodWait. Возвращает статус для журнала."""
+    while True:
+        await _acquire(bucket)
+        try:
+            await app.send_message(uid, message)
+            return 'delivered'
+        except FloodWait as e:
+            print(f"FloodWait {e.value}s, pausing broadcast")
+            bucket.block(time.monotonic(), float(e.value))
+        except DEAD_USER_ERRORS:
+            return 'blocked'
+        except Exception as e:
+            print(f"Failed to send to {uid}: {e}")
+            return 'failed'
+
+
+async def _report(stats, total, started):
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        done = stats['delivered'] + stats['failed'] + stats['blocked']
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed else 0
+        left = max(total - stats['skipped'] - done, 0)
+        eta = left / rate if rate else float('inf')
+        print(
+            f"{done}/{total - stats['skipped']} sent={stats['delivered']} failed={stats['failed']} "
+            f"blocked={stats['blocked']} {rate:.1f} msg/s ETA {eta:.0f}s"
+        )
+
 
 async def broadcast():
     # Read message to send
@@ -22,19 +122,58 @@ async def broadcast():
     if not message:
         print("Message file is empty.")
         return
+    if not os.path.isfile(USERS_LOG) and not os.path.isfile(USERS_FILE):
+        print(f"Users file not found: {USERS_LOG}")
+        return
+
+    checkpoint = Checkpoint(CHECKPOINT_FILE, message)
+    if checkpoint.done:
+        print(f"Resuming broadcast: {len(checkpoint.done)} users already processed")
+    total = sum(1 for _ in iter_users(USERS_LOG, USERS_FILE))
+    stats = {'delivered': 0, 'failed': 0, 'blocked': 0, 'skipped': 0}
+    bucket = TokenBucket(BROADCAST_RATE, capacity=BROADCAST_RATE)
+    queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
 
     app = Client("ytbot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+
+    async def worker():
+        while True:
+            uid = await queue.get()
+            if uid is None:
+                return
+            status = await _send(app, uid, message, bucket)
+            stats[status] += 1
+            checkpoint.record(uid, status)
+
     async with app:
-        if not os.path.isfile(USERS_FILE):
-            print(f"Users file not found: {USERS_FILE}")
-            return
-        with open(USERS_FILE, 'r', encoding='utf-8') as uf:
-            users = json.load(uf)
-        for uid in users:
-            try:
-                await app.send_message(uid, message)
-            except Exception as e:
-                print(f"Failed to send to {uid}: {e}")
+        started = time.monotonic()
+        reporter = asyncio.create_task(_report(stats, total, started))
+        workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_CONCURRENCY)]
+        try:
+            for uid in iter_users(USERS_LOG, USERS_FILE):
+                if not checkpoint.should_send(uid):
+                    stats['skipped'] += 1
+                    continue
+                await queue.put(uid)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            checkpoint.close()
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Done in {elapsed:.0f}s: sent={stats['delivered']} failed={stats['failed']} "
+        f"blocked={stats['blocked']} skipped={stats['skipped']}"
+    )
+
+    # users who blocked the bot or deleted their account are dropped from the registry
+    registry = UserRegistry(USERS_LOG, legacy_path=USERS_FILE)
+    dead = [uid for uid in checkpoint.blocked() if uid in registry]
+    if dead:
+        registry.remove(dead)
+        print(f"Removed {len(dead)} unreachable users from {USERS_LOG}")
 
 if __name__ == '__main__':
-    asyncio.run(broadcast())
\ No newline at end of file
+    asyncio.run(broadcast())
@@ -0,0 +1,121 @@
+# Rough CPU cost in CPU-seconds per second of media, used only to report what a plan saves
+REMUX_COST = 0.002
+ENCODE_COST = {'mp3': 0.02, 'opus': 0.015, 'flac': 0.006, 'wav': 0.001}
+# A source in the target codec is taken only if it is not noticeably worse than the best audio
+MATCH_MIN_BITRATE = 0.75
+
+
+def codec_family(codec):
+    """'mp4a.40.2' -> 'aac', 'opus' -> 'opus' и т.д.; None для неизвестного кодека."""
+    if not codec:
+        return None
+    codec = codec.lower()
+    if codec.startswith('mp4a') or codec == 'aac':
+        return 'aac'
+    if codec.startswith('mp3'):
+        return 'mp3'
+    return codec.split('.')[0]
+
+
+class Plan:
+    """Что скачивать и как обрабатывать: селектор yt-dlp, постобработка, итоговое расширение и причина выбора."""
+
+    __slots__ = ('selector', 'postprocessors', 'merge_format', 'ext', 'reason', 'saved', 'size')
+
+    def __init__(self, selector, ext, reason, postprocessors=None, merge_format=None, saved=0.0, size=None):
+        self.selector = selector
+        self.ext = ext
+        self.reason = reason
+        self.postprocessors = postprocessors or []
+        self.merge_format = merge_format
+        self.saved = saved
+        # expected output size in bytes from filesize/filesize_approx, None if unknown
+        self.size = size
+
+    def apply(self, opts):
+        """Дописать план в опции YoutubeDL."""
+        opts['format'] = self.selector
+        if self.merge_format:
+            opts['merge_output_format'] = self.merge_format
+        if self.postprocessors:
+            opts['postprocessors'] = list(self.postprocessors)
+        return opts
+
+
+def plan_video(manifest, res):
+    """
+    План для видео до `res`p.
+
+    Порядок предпочтений: прогрессивный mp4 нужной высоты (один файл, без слияния),
+    затем видео + аудио, которые копируются в mp4 без перекодирования (для mp4 берётся
+    AAC-дорожка, если она не хуже лучшей).
+    """
+    fallback = f"bestvideo[ext=mp4][height<={res}]+bestaudio/best"
+    duration = manifest.duration or 0
+    heights = [h for h in manifest.heights() if h <= res]
+    if not heights:
+        return Plan(fallback, 'mp4', "no format data, generic selector", merge_format='mp4')
+    height = heights[0]
+
+    progressive = [
+        f for f in manifest.formats
+        if f.progressive and f.height == height and f.ext == 'mp4'
+    ]
+    if progressive:
+        f = max(progressive, key=lambda f: f.tbr or 0)
+        return Plan(
+            f"{f.format_id}/{fallback}", 'mp4',
+            f"progressive {f.format_id} {height}p mp4, no merge",
+            merge_format='mp4', saved=REMUX_COST * duration, size=f.size,
+        )
+
+    # the requested height first, mp4 if possible: 1440p/4K are often only VP9/AV1 in webm
+    video = manifest.best_video(height)
+    if video is None or video.height != height:
+        video = manifest.best_video(height, ext=None)
+    audio = _best_audio_for(manifest, 'aac')
+    if video is None or audio is None:
+        return Plan(fallback, 'mp4', "no separate streams found, generic selector", merge_format='mp4')
+    reason = (
+        f"{video.format_id} {video.vcodec} {video.ext} + {audio.format_id} {audio.acodec} "
+        f"stream copy into mp4"
+    )
+    size = video.size + (audio.size or 0) if video.size else None
+    return Plan(f"{video.format_id}+{audio.format_id}/{fallback}", 'mp4', reason, merge_format='mp4', size=size)
+
+
+def _audio_formats(manifest):
+    return [f for f in manifest.formats if f.has_audio and not f.has_video]
+
+
+def _best_audio_for(manifest, family):
+    """Лучшая дорожка кодека `family`, если она не сильно хуже лучшей вообще; иначе просто лучшая."""
+    best = manifest.best_audio()
+    if best is None:
+        return None
+    matching = [f for f in _audio_formats(manifest) if codec_family(f.acodec) == family]
+    if matching:
+        match = max(matching, key=lambda f: f.tbr or 0)
+        if (match.tbr or 0) >= (best.tbr or 0) * MATCH_MIN_BITRATE:
+            return match
+    return best
+
+
+def plan_source(manifest):
+    """
+    План загрузки исходной аудиодорожки без постобработки: из неё локально
+    делаются все запрошенные форматы (см. transcode.Transcoder).
+    """
+    fallback = 'bestaudio/best'
+    best = manifest.best_audio()
+    if best is None:
+        return Plan(fallback, None, "no format data, best audio kept as source")
+    return Plan(
+        f"{best.format_id}/{fallback}", best.ext,
+        f"source {best.format_id} {best.acodec} {best.ext} kept for local conversion",
+    )
+
+
+def copy_saving(fmt, duration):
+    """Сколько CPU-секунд сэкономило копирование дорожки вместо перекодирования в `fmt`."""
+    return ENCODE_COST.get(fmt, 0) * (duration or 0)
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from pyrogram.errors import FloodWait, MessageNotModified
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for one idle sleep of the edit loop while every pending chat is rate-limited
+MAX_IDLE_SLEEP = 0.25
+
+
+class TokenBucket:
+    """Простой token bucket: `rate` токенов в секунду, не больше `capacity` в запасе."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже доступен)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+def _message_key(msg):
+    mid = getattr(msg, "message_id", None)
+    if mid is None:
+        mid = getattr(msg, "id", None)
+    return msg.chat.id, mid
+
+
+class ProgressService:
+    """
+    Сервис правок статус-сообщений с учётом лимитов Telegram.
+
+    Для каждого сообщения хранится только последний ещё не отправленный текст:
+    новый текст заменяет ожидающий, поэтому устаревшие проценты не копятся.
+    Правки ограничены token bucket'ом на чат и общим bucket'ом на бота,
+    а при FloodWait чат (или весь бот, если ожидание длинное) ставится на паузу
+    и правка повторяется позже, а не теряется.
+    """
+
+    def __init__(self, per_chat_interval=1.0, global_rate=25.0):
+        self.per_chat_rate = 1.0 / max(float(per_chat_interval), 0.01)
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets = {}
+        self._pending = OrderedDict()
+        self._last_sent = {}
+        self._closed = OrderedDict()
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+        self.replaced = 0
+        self.flood_waits = 0
+
+    @property
+    def backlog(self):
+        return len(self._pending)
+
+    def update(self, msg, text):
+        """Поставить `text` как следующее состояние `msg`. Вызывать из потока event loop."""
+        key = _message_key(msg)
+        if key in self._closed:
+            return
+        if key not in self._pending and self._last_sent.get(key) == text:
+            return
+        if key in self._pending:
+            self.replaced += 1
+        self._pending[key] = (msg, text)
+        self._ensure_running()
+        self._wakeup.set()
+
+    def update_threadsafe(self, loop, msg, text):
+        """То же, что update(), но из потоков загрузки/отправки."""
+        loop.call_soon_threadsafe(self.update, msg, text)
+
+    def discard(self, msg):
+        """Забыть сообщение перед его удалением; запоздавшие обновления из потоков игнорируются."""
+        key = _message_key(msg)
+        self._pending.pop(key, None)
+        self._last_sent.pop(key, None)
+        self._closed[key] = None
+        if len(self._closed) > 10000:
+            self._closed.popitem(last=False)
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    def _next_ready(self, now):
+        # oldest pending message whose chat may be edited right now, otherwise the shortest wait
+        wait = None
+        for key in self._pending:
+            delay = self._bucket(key[0]).delay(now)
+            if delay == 0:
+                return key, 0.0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            key, wait = self._next_ready(now)
+            global_wait = self.global_bucket.delay(now)
+            if key is None or global_wait:
+                # short polling sleep: a chat that becomes ready sooner is not starved by a long FloodWait
+                await asyncio.sleep(min(max(wait or 0, global_wait), MAX_IDLE_SLEEP))
+                continue
+
+            msg, text = self._pending.pop(key)
+            self._bucket(key[0]).take(now)
+            self.global_bucket.take(now)
+            try:
+                await msg.edit_text(text)
+            except MessageNotModified:
+                pass
+            except FloodWait as e:
+                self.flood_waits += 1
+                seconds = float(e.value)
+                logger.warning(f"FloodWait {seconds}s on chat {key[0]}, backing off")
+                self._bucket(key[0]).block(time.monotonic(), seconds)
+                if seconds > 5:
+                    # long waits are account-wide, pause everything
+                    self.global_bucket.block(time.monotonic(), seconds)
+                # keep the newest text: re-queue only if nothing newer arrived meanwhile
+                self._pending.setdefault(key, (msg, text))
+                continue
+            except Exception as e:
+                # message deleted, chat unavailable etc. — nothing to retry
+                logger.debug(f"Edit of {key} dropped: {e}")
+            self.sent += 1
+            self._last_sent[key] = text
+            # keep _last_sent bounded
+            if len(self._last_sent) > 10000:
+                self._last_sent.pop(next(iter(self._last_sent)))
@@ -1,107 +1,125 @@
+"""
+Экспорт куки браузера в cookies.txt (формат Netscape), который читает бот.
+
+    python refresh.py                  # firefox, затем chromium и chrome
+    python refresh.py chrome           # конкретный браузер
+    python refresh.py firefox:work     # браузер и профиль
+
+Профили ищет и расшифровывает yt-dlp: Firefox и Chromium/Chrome на Linux
+(пароль из keyring) и Windows (один ключ DPAPI на всю базу, а не вызов на строку).
+Берутся только домены из cookie_domains в config.json. Файл переписывается,
+только если какие-то записи изменились, поэтому бот перечитывает его (по mtime)
+лишь при реальных изменениях. Удобно запускать по расписанию (cron).
+"""
 import os
-import shutil
-import sqlite3
 import sys
-import tempfile
-
-try:
-    import win32crypt
-except ImportError:
-    print("Ошибка: нет win32crypt (pywin32). Установи через 'pip install pywin32' и запускай снова.")
-    sys.exit(1)
-
-def get_chrome_cookies_db_path():
-    local_app_data = os.environ.get("LOCALAPPDATA")
-    if not local_app_data:
-        raise RuntimeError("Не найдена переменная окружения LOCALAPPDATA")
-    # Собираем путь по частям, чтобы не было проблем с "\" в строке
-    path = os.path.join(
-        local_app_data,
-        "Google", "Chrome", "User Data", "Default", "Network", "Cookies"
-    )
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"Не найден файл куки по пути: {path}")
-    return path
+import json
 
-def copy_db_to_temp(src_path):
-    """
-    Чтобы Chrome не ругался на лок (он может блокировать файл), копируем базу в temp.
-    """
-    tmp_dir = tempfile.mkdtemp(prefix="chrome_cookies_")
-    dst_path = os.path.join(tmp_dir, "Cookies_copy.db")
-    shutil.copy2(src_path, dst_path)
-    return dst_path
+from cookie_store import HTTPONLY_PREFIX, domain_matches, entry_domain
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
+
+DEFAULT_BROWSERS = ('firefox', 'chromium', 'chrome')
+DEFAULT_DOMAINS = ('yandex.ru', 'yandex.com', 'yandex.by', 'yandex.kz')
 
-def decrypt_cookie(encrypted_value):
+HEADER = (
+    "# Netscape HTTP Cookie File\n"
+    "# Сгенерировано автоматически, не бейте кукишник!\n\n"
+)
+
+
+def entry_key(line):
+    """(домен, путь, имя) строки cookies.txt — по нему сравниваются старые и новые записи."""
+    if line.startswith(HTTPONLY_PREFIX):
+        line = line[len(HTTPONLY_PREFIX):]
+    fields = line.rstrip('\n').split('\t')
+    return fields[0], fields[2], fields[5]
+
+
+def cookie_line(cookie):
     """
-    Расшифровываем через Win DPAPI (win32crypt).
-    Если что пошло не так — возвращаем пустую строку.
+    Строка Netscape:
+    <домен>\t<флаг_поддоменов>\t<путь>\t<secure>\t<expires>\t<имя>\t<значение>
     """
+    include_subdomains = "TRUE" if cookie.domain.startswith('.') else "FALSE"
+    secure_flag = "TRUE" if cookie.secure else "FALSE"
+    return (
+        f"{cookie.domain}\t{include_subdomains}\t{cookie.path}\t{secure_flag}\t"
+        f"{cookie.expires or 0}\t{cookie.name}\t{cookie.value or ''}\n"
+    )
+
+
+def read_entries(path):
+    """Записи существующего cookies.txt: {(домен, путь, имя): строка}."""
+    entries = {}
     try:
-        decrypted = win32crypt.CryptUnprotectData(encrypted_value, None, None, None, 0)[1]
-        return decrypted.decode("utf-8", errors="ignore")
-    except Exception:
-        return ""
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if entry_domain(line) is not None:
+                    entries[entry_key(line)] = line
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def browser_entries(browser, profile, domains):
+    from yt_dlp.cookies import extract_cookies_from_browser
+    jar = extract_cookies_from_browser(browser, profile)
+    lines = (cookie_line(c) for c in jar if domain_matches(c.domain, domains))
+    return {entry_key(line): line for line in lines}
 
-def chrome_ts_to_unix(ts):
-    """
-    Хром хранит timestamp в микросекундах от 1601-01-01.
-    Переводим в UNIX (секунды от 1970-01-01).
-    """
-    if ts == 0:
-        return 0
-    return int(ts / 1_000_000 - 11644473600)
 
-def export_to_netscape(db_path, output_path):
+def export(path, domains=DEFAULT_DOMAINS, browsers=DEFAULT_BROWSERS):
     """
-    Открываем копию файла, читаем таблицу cookies и пилим строки в формате Netscape:
-    <домен>\t<флаг_поддоменов>\t<путь>\t<secure>\t<expires>\t<имя>\t<значение>\n
+    Обновить `path` куками первого браузера из `browsers`, где они нашлись.
+    Записи других доменов не трогаются. Возвращает (добавлено, изменено, удалено).
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT host_key, name, path, expires_utc, is_secure, is_httponly, encrypted_value
-        FROM cookies
-    """)
-
-    header = (
-        "# Netscape HTTP Cookie File\n"
-        "# Сгенерировано автоматически, не бейте кукишник!\n\n"
-    )
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(header)
-        for host_key, name, path_, expires_utc, is_secure, is_httponly, encrypted_value in cursor.fetchall():
-            include_subdomains = "TRUE" if host_key.startswith('.') else "FALSE"
-            value = decrypt_cookie(encrypted_value)
-            expiry = chrome_ts_to_unix(expires_utc)
-            secure_flag = "TRUE" if is_secure else "FALSE"
-            # В формате Netscape нет отдельного поля для HttpOnly, поэтому просто пропускаем is_httponly.
-            line = f"{host_key}\t{include_subdomains}\t{path_}\t{secure_flag}\t{expiry}\t{name}\t{value}\n"
-            f.write(line)
-
-    conn.close()
+    fresh, errors = None, []
+    for spec in browsers:
+        browser, _, profile = spec.partition(':')
+        try:
+            fresh = browser_entries(browser, profile or None, domains)
+        except Exception as e:
+            errors.append(f"{spec}: {e}")
+            continue
+        if fresh:
+            break
+    if not fresh:
+        raise RuntimeError('; '.join(errors) or f"в {', '.join(browsers)} нет куки для {', '.join(domains)}")
+
+    old = read_entries(path)
+    added = fresh.keys() - old.keys()
+    changed = {key for key in fresh.keys() & old.keys() if fresh[key] != old[key]}
+    removed = {key for key in old if domain_matches(key[0], domains) and key not in fresh}
+    if added or changed or removed:
+        entries = {key: line for key, line in old.items() if key not in removed}
+        entries.update(fresh)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(HEADER)
+            f.writelines(entries.values())
+        os.replace(tmp, path)
+    return len(added), len(changed), len(removed)
+
 
 def main():
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        cfg = json.load(f)
+    output_file = os.path.join(BASE_DIR, cfg.get('cookies_file', "cookies.txt"))
+    domains = cfg.get('cookie_domains') or DEFAULT_DOMAINS
+    browsers = sys.argv[1:] or DEFAULT_BROWSERS
+
     try:
-        src = get_chrome_cookies_db_path()
+        added, changed, removed = export(output_file, domains, browsers)
     except Exception as e:
-        print("Не удалось найти базу куки Chrome:", e)
+        print("Не удалось получить куки из браузера:", e)
         sys.exit(1)
+    if added or changed or removed:
+        print(f"[OK] {output_file}: +{added} новых, {changed} изменено, -{removed} удалено")
+    else:
+        print(f"[OK] {output_file} не изменился")
 
-    tmp_db = copy_db_to_temp(src)
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    output_file = os.path.join(script_dir, "cookies.txt")
-
-    try:
-        export_to_netscape(tmp_db, output_file)
-        print(f"[OK] cookies.txt сохранён сюда: {output_file}")
-    except Exception as e:
-        print("Что-то пошло не так при экспорте:", e)
-    finally:
-        try:
-            os.remove(tmp_db)
-        except OSError:
-            pass
 
 if __name__ == "__main__":
     main()
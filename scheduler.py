@@ -0,0 +1,150 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Lower value is dispatched first: audio jobs are short and may overtake video merges
+PRIORITY_AUDIO = 0
+PRIORITY_VIDEO = 1
+
+
+class _Job:
+    __slots__ = ('user_id', 'priority', 'seq', 'future', 'on_position', 'position')
+
+    def __init__(self, user_id, priority, seq, future, on_position):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class JobScheduler:
+    """
+    Планировщик загрузок с общим и пользовательским лимитом одновременных задач.
+
+    Пользователи обслуживаются по кругу, внутри очереди пользователя и между
+    пользователями аудио-задачи идут раньше видео. Ожидающим задачам через
+    `on_position(pos)` сообщается их место в общей очереди.
+    Сама работа выполняется в собственном пуле потоков `executor` размером с общий лимит.
+    """
+
+    def __init__(self, global_limit=4, per_user_limit=1):
+        self.global_limit = int(global_limit)
+        self.per_user_limit = int(per_user_limit)
+        self.executor = ThreadPoolExecutor(max_workers=self.global_limit, thread_name_prefix='download')
+        self._queues = {}
+        self._users = deque()
+        self._active = {}
+        self._running = 0
+        self._seq = itertools.count()
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def queued(self):
+        return sum(len(q) for q in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, user_id, priority=PRIORITY_VIDEO, on_position=None):
+        """Дождаться свободного слота для пользователя и удерживать его до выхода из блока."""
+        loop = asyncio.get_running_loop()
+        job = _Job(user_id, priority, next(self._seq), loop.create_future(), on_position)
+        if user_id not in self._queues:
+            self._queues[user_id] = []
+            self._users.append(user_id)
+        heapq.heappush(self._queues[user_id], job)
+        self._dispatch()
+
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job.future.done() and not job.future.cancelled():
+                self._release(user_id)
+            else:
+                self._remove(job)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    def _pick(self):
+        best = None
+        for uid in self._users:
+            if self._active.get(uid, 0) >= self.per_user_limit:
+                continue
+            head = self._queues[uid][0]
+            if best is None or head.priority < best.priority:
+                best = head
+        return best
+
+    def _dispatch(self):
+        while self._running < self.global_limit:
+            job = self._pick()
+            if job is None:
+                break
+            queue = self._queues[job.user_id]
+            heapq.heappop(queue)
+            # served user goes to the back of the round
+            self._users.remove(job.user_id)
+            if queue:
+                self._users.append(job.user_id)
+            else:
+                del self._queues[job.user_id]
+            self._running += 1
+            self._active[job.user_id] = self._active.get(job.user_id, 0) + 1
+            job.future.set_result(None)
+        self._report_positions()
+
+    def _release(self, user_id):
+        self._running -= 1
+        left = self._active.get(user_id, 1) - 1
+        if left:
+            self._active[user_id] = left
+        else:
+            self._active.pop(user_id, None)
+        self._dispatch()
+
+    def _remove(self, job):
+        queue = self._queues.get(job.user_id)
+        if not queue or job not in queue:
+            return
+        queue.remove(job)
+        heapq.heapify(queue)
+        if not queue:
+            del self._queues[job.user_id]
+            self._users.remove(job.user_id)
+        self._report_positions()
+
+    def _report_positions(self):
+        # estimated service order: priority first, then the round the job falls into, then user order
+        order = []
+        for user_rank, uid in enumerate(self._users):
+            for round_no, job in enumerate(sorted(self._queues[uid])):
+                order.append(((job.priority, round_no, user_rank), job))
+        order.sort(key=lambda item: item[0])
+        for pos, (_, job) in enumerate(order, start=1):
+            if job.position == pos:
+                continue
+            job.position = pos
+            if job.on_position:
+                try:
+                    job.on_position(pos)
+                except Exception as e:
+                    logger.error(f"Queue position callback failed: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
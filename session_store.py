@@ -0,0 +1,119 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How often (seconds) expired rows are swept during normal writes
+PURGE_INTERVAL = 300
+
+
+class SessionStore:
+    """
+    Хранилище сессий клавиатур в SQLite (WAL).
+
+    Каждая операция затрагивает ровно один ключ, поэтому стоимость get/put/delete
+    не зависит от общего числа сессий, а параллельные обработчики не затирают
+    записи друг друга. Сессии живут `ttl` секунд с момента последней записи.
+    """
+
+    def __init__(self, path, ttl=86400.0):
+        self.path = path
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " key TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " expires REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires)")
+        self.purge_expired()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, expires FROM sessions WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        data, expires = row
+        if expires < time.time():
+            self.delete(key)
+            return None
+        return json.loads(data)
+
+    def put(self, key, data, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else float(ttl))
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (key, data, expires) VALUES (?, ?, ?)",
+                (key, payload, expires)
+            )
+        if time.monotonic() - self._last_purge > PURGE_INTERVAL:
+            self.purge_expired()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def pop(self, key, default=None):
+        sess = self.get(key)
+        if sess is None:
+            return default
+        self.delete(key)
+        return sess
+
+    def purge_expired(self):
+        """Удалить все просроченные сессии. Возвращает число удалённых строк."""
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+            self._last_purge = time.monotonic()
+        if cur.rowcount:
+            logger.info(f"Purged {cur.rowcount} expired sessions")
+        return cur.rowcount
+
+    def migrate_json(self, json_path):
+        """
+        Одноразово перенести сессии из старого sessions.json.
+        После переноса файл переименовывается в `*.migrated`, чтобы не импортировать его повторно.
+        """
+        if not os.path.isfile(json_path):
+            return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot read legacy sessions file {json_path}: {e}")
+            return 0
+        expires = time.time() + self.ttl
+        rows = [
+            (key, json.dumps(sess, ensure_ascii=False, separators=(',', ':')), expires)
+            for key, sess in legacy.items()
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # existing keys win: they were written by the new backend and are fresher
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO sessions (key, data, expires) VALUES (?, ?, ?)", rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        os.replace(json_path, json_path + '.migrated')
+        logger.info(f"Migrated {len(rows)} sessions from {json_path}")
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
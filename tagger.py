@@ -0,0 +1,106 @@
+import base64
+
+from mutagen import id3
+from mutagen.flac import FLAC, Picture
+from mutagen.oggopus import OggOpus
+from mutagen.wave import WAVE
+
+# Cost of the ffmpeg pass that only rewrote tags (FFmpegMetadata): process start and a full copy of the file
+METADATA_PASS_START = 0.2
+METADATA_PASS_RATE = 150 * 1024 * 1024
+# Tag name -> ID3 frame (MP3 and WAV); Ogg Opus and FLAC use the names as Vorbis comments
+ID3_FRAMES = {'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB', 'date': 'TDRC'}
+# Front cover, see ID3 APIC / FLAC METADATA_BLOCK_PICTURE
+COVER_FRONT = 3
+
+
+def cover_mime(data):
+    """MIME обложки по сигнатуре; None для форматов, которые плееры не показывают (например, webp)."""
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    return None
+
+
+def _picture(data, mime):
+    pic = Picture()
+    pic.type = COVER_FRONT
+    pic.mime = mime
+    pic.desc = 'Cover'
+    pic.data = data
+    return pic
+
+
+def _tag_id3(tags, values, cover):
+    for key, value in values.items():
+        frame = ID3_FRAMES.get(key)
+        if frame:
+            tags.setall(frame, [getattr(id3, frame)(encoding=3, text=value)])
+    if cover:
+        tags.setall('APIC', [id3.APIC(encoding=3, mime=cover[1], type=COVER_FRONT, desc='Cover', data=cover[0])])
+
+
+def _tag_mp3(path, values, cover):
+    try:
+        tags = id3.ID3(path)
+    except id3.ID3NoHeaderError:
+        tags = id3.ID3()
+    _tag_id3(tags, values, cover)
+    tags.save(path)
+
+
+def _tag_wav(path, values, cover):
+    audio = WAVE(path)
+    if audio.tags is None:
+        audio.add_tags()
+    _tag_id3(audio.tags, values, cover)
+    audio.save()
+
+
+def _tag_opus(path, values, cover):
+    audio = OggOpus(path)
+    for key, value in values.items():
+        audio[key] = [value]
+    if cover:
+        audio['metadata_block_picture'] = [base64.b64encode(_picture(*cover).write()).decode('ascii')]
+    audio.save()
+
+
+def _tag_flac(path, values, cover):
+    audio = FLAC(path)
+    for key, value in values.items():
+        audio[key] = [value]
+    if cover:
+        audio.clear_pictures()
+        audio.add_picture(_picture(*cover))
+    audio.save()
+
+
+WRITERS = {'mp3': _tag_mp3, 'wav': _tag_wav, 'opus': _tag_opus, 'flac': _tag_flac}
+
+
+def write_tags(path, fmt, tags, cover=None):
+    """
+    Записать теги `tags` ({'title': ..., 'artist': ...}) и обложку (путь к
+    JPEG/PNG) прямо в файл формата `fmt` через mutagen, без прохода ffmpeg.
+    Возвращает True, если файл изменён.
+    """
+    writer = WRITERS.get(fmt)
+    values = {key: str(value) for key, value in (tags or {}).items() if value}
+    picture = None
+    if cover:
+        with open(cover, 'rb') as f:
+            data = f.read()
+        mime = cover_mime(data)
+        if mime:
+            picture = (data, mime)
+    if writer is None or not (values or picture):
+        return False
+    writer(path, values, picture)
+    return True
+
+
+def metadata_pass_cost(size):
+    """Во сколько секунд обошёлся бы отдельный проход ffmpeg, переписывающий файл размера `size` ради тегов."""
+    return METADATA_PASS_START + size / METADATA_PASS_RATE
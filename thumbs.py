@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """
+    Общий HTTP-клиент с пулом keep-alive соединений.
+
+    Запросы выполняются в небольшом собственном пуле потоков, поэтому из корутин
+    их можно просто await'ить, не блокируя event loop бота.
+    """
+
+    def __init__(self, pool_size=8, timeout=10):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=1)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='http')
+
+    async def get_bytes(self, url):
+        """Скачать `url` целиком; None, если ответ не 2xx."""
+        def fetch():
+            r = self.session.get(url, timeout=self.timeout)
+            return r.content if r.ok else None
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fetch)
+
+    def close(self):
+        self.session.close()
+        self.executor.shutdown(wait=False)
+
+
+class ThumbnailCache:
+    """
+    Дисковый кеш обложек с ограничением по размеру и LRU-вытеснением.
+
+    Ключ — id ролика (или URL обложки), поэтому обложка качается один раз на все
+    форматы и всех пользователей. Порядок LRU определяется mtime файла, который
+    обновляется при каждом попадании.
+    """
+
+    def __init__(self, directory, max_bytes, client):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.client = client
+        self._inflight = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jpg')
+
+    async def get(self, url, key=None):
+        """Путь к локальной копии обложки или None, если её не удалось получить."""
+        if not url:
+            return None
+        path = self._path(key or url)
+        if os.path.isfile(path):
+            os.utime(path)
+            return path
+
+        fut = self._inflight.get(path)
+        if fut is None:
+            fut = self._inflight[path] = asyncio.ensure_future(self._fetch(url, path))
+            fut.add_done_callback(lambda _: self._inflight.pop(path, None))
+        return await asyncio.shield(fut)
+
+    async def _fetch(self, url, path):
+        try:
+            content = await self.client.get_bytes(url)
+        except Exception as e:
+            logger.warning(f"Thumbnail fetch failed for {url}: {e}")
+            return None
+        if not content:
+            return None
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+        self._evict()
+        return path
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
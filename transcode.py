@@ -0,0 +1,122 @@
+import os
+import glob
+import shutil
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE = shutil.which('ffprobe') or 'ffprobe'
+
+# Encoder settings matching yt-dlp's FFmpegExtractAudio with preferredquality '0'
+ENCODERS = {
+    'mp3': ['-c:a', 'libmp3lame', '-q:a', '0'],
+    'opus': ['-c:a', 'libopus', '-b:a', '256k'],
+    'flac': ['-c:a', 'flac'],
+    'wav': ['-c:a', 'pcm_s16le'],
+}
+MUXERS = {'mp3': 'mp3', 'opus': 'opus', 'flac': 'flac', 'wav': 'wav'}
+# Container extension -> audio codec family, for sources of unknown codec
+EXT_CODECS = {'webm': 'opus', 'opus': 'opus', 'm4a': 'aac', 'mp4': 'aac', 'mp3': 'mp3', 'flac': 'flac', 'wav': 'wav'}
+
+# Parts are cut at keyframes, so segments are planned smaller than the limit
+SPLIT_MARGIN = 0.9
+SPLIT_ATTEMPTS = 3
+
+
+class TranscodeError(Exception):
+    pass
+
+
+async def _run(args):
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        out, err = await proc.communicate()
+    except BaseException:
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise TranscodeError(
+            err.decode('utf-8', 'replace').strip()[-500:] or f"{os.path.basename(args[0])} exited with {proc.returncode}"
+        )
+    return out
+
+
+async def probe_duration(path):
+    """Длительность файла в секундах по ffprobe."""
+    out = await _run([FFPROBE, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path])
+    return float(out.decode().strip())
+
+
+class Transcoder:
+    """
+    Локальная конвертация исходной дорожки в нужные форматы через ffmpeg.
+
+    Одновременно работает не больше `jobs` процессов ffmpeg, остальные ждут;
+    несколько форматов одного трека конвертируются параллельно. Если кодек
+    источника совпадает с целевым, дорожка копируется без перекодирования.
+    """
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs or os.cpu_count() or 2
+        self._slots = asyncio.Semaphore(self.jobs)
+        self.encoded = 0
+        self.copied = 0
+
+    async def convert(self, source, codec, target, fmt):
+        """Записать `source` (кодек `codec`) в `target` формата `fmt`. Возвращает 'copy' или 'encode'."""
+        codec = codec or EXT_CODECS.get(os.path.splitext(source)[1].lstrip('.'))
+        mode = 'copy' if codec == fmt else 'encode'
+        args = [FFMPEG, '-y', '-v', 'error', '-i', source, '-vn', '-map_metadata', '0']
+        args += ['-c:a', 'copy'] if mode == 'copy' else ENCODERS[fmt]
+        tmp = target + '.part'
+        args += ['-f', MUXERS[fmt], tmp]
+
+        async with self._slots:
+            try:
+                await _run(args)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+        os.replace(tmp, target)
+        if mode == 'copy':
+            self.copied += 1
+        else:
+            self.encoded += 1
+        logger.info(f"{mode} {os.path.basename(source)} ({codec}) -> {fmt}")
+        return mode
+
+    async def split(self, path, max_bytes, directory, duration=None):
+        """
+        Разрезать `path` на части не больше `max_bytes` без перекодирования (ffmpeg segment, -c copy).
+        Части пишутся в `directory`; возвращает их пути по порядку.
+        """
+        size = os.path.getsize(path)
+        if not duration:
+            duration = await probe_duration(path)
+        ext = os.path.splitext(path)[1]
+        pattern = os.path.join(directory, f"part%03d{ext}")
+        margin = SPLIT_MARGIN
+        for _ in range(SPLIT_ATTEMPTS):
+            for old in glob.glob(os.path.join(glob.escape(directory), 'part*')):
+                os.remove(old)
+            segment = max(duration * max_bytes * margin / size, 1.0)
+            async with self._slots:
+                await _run([
+                    FFMPEG, '-y', '-v', 'error', '-i', path, '-map', '0', '-c', 'copy',
+                    '-f', 'segment', '-segment_time', f"{segment:.2f}", '-reset_timestamps', '1', pattern,
+                ])
+            parts = sorted(glob.glob(os.path.join(glob.escape(directory), f"part*{ext}")))
+            if parts and all(os.path.getsize(p) <= max_bytes for p in parts):
+                logger.info(f"Split {os.path.basename(path)} ({size} bytes) into {len(parts)} parts")
+                return parts
+            # sparse keyframes made a part too big, cut shorter
+            margin *= 0.7
+        raise TranscodeError(f"cannot split {os.path.basename(path)} into parts below {max_bytes} bytes")
@@ -0,0 +1,211 @@
+import os
+import math
+import time
+import asyncio
+import hashlib
+import inspect
+import logging
+import itertools
+from pathlib import PurePath
+
+from pyrogram import Client, raw
+from pyrogram.errors import FloodWait, InternalServerError, ServiceUnavailable
+from pyrogram.session import Session
+
+logger = logging.getLogger(__name__)
+
+# Telegram limits: parts are at most 512 KiB, files above 10 MiB go through SaveBigFilePart
+PART_SIZE = 512 * 1024
+BIG_FILE = 10 * 1024 * 1024
+# Parts in flight on one connection
+PARTS_PER_CONNECTION = 4
+# Part failures worth another attempt; anything else (bad request, file too big) fails at once
+RETRYABLE = (OSError, asyncio.TimeoutError, InternalServerError, ServiceUnavailable, FloodWait)
+
+
+class UploadError(Exception):
+    """Часть файла не загрузилась после всех попыток; загруженные части остаются для продолжения."""
+
+
+class _Upload:
+    __slots__ = ('file_id', 'total', 'big', 'done', 'md5', 'touched')
+
+    def __init__(self, file_id, size):
+        self.file_id = file_id
+        self.total = math.ceil(size / PART_SIZE)
+        self.big = size > BIG_FILE
+        self.done = set()
+        self.md5 = None
+        self.touched = time.monotonic()
+
+
+def _md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Uploader:
+    """
+    Загрузка файлов в Telegram по частям через несколько соединений.
+
+    Части файла идут параллельно по `connections` медиа-сессиям (до
+    PARTS_PER_CONNECTION частей на сессию одновременно), каждая часть
+    повторяется отдельно до `part_retries` раз. Какие части уже на сервере,
+    запоминается по (путь, размер, mtime) на `resume_ttl` секунд: повторная
+    отправка того же файла после ошибки догружает только недостающие части,
+    а после успешной — не грузит ничего. Файл открыт только на время загрузки
+    и закрывается при любом исходе.
+    """
+
+    def __init__(self, client, connections=4, part_retries=5, resume_ttl=3600):
+        self.client = client
+        self.connections = max(int(connections), 1)
+        self.part_retries = int(part_retries)
+        self.resume_ttl = resume_ttl
+        self._sessions = []
+        self._next_session = itertools.count()
+        self._sessions_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(self.connections * PARTS_PER_CONNECTION)
+        self._uploads = {}
+        self.retries = 0
+        self.resumed = 0
+
+    async def _session(self):
+        async with self._sessions_lock:
+            if len(self._sessions) < self.connections:
+                session = Session(
+                    self.client, await self.client.storage.dc_id(), await self.client.storage.auth_key(),
+                    await self.client.storage.test_mode(), is_media=True
+                )
+                await session.start()
+                self._sessions.append(session)
+                return session
+        return self._sessions[next(self._next_session) % len(self._sessions)]
+
+    def _state(self, path, size):
+        now = time.monotonic()
+        for key in [k for k, u in self._uploads.items() if now - u.touched > self.resume_ttl]:
+            del self._uploads[key]
+        key = (os.path.realpath(path), size, os.stat(path).st_mtime_ns)
+        upload = self._uploads.get(key)
+        if upload is None:
+            upload = self._uploads[key] = _Upload(self.client.rnd_id(), size)
+        elif upload.done:
+            self.resumed += 1
+            logger.info(f"Resuming upload of {os.path.basename(path)}: {len(upload.done)}/{upload.total} parts on the server")
+        upload.touched = now
+        return upload
+
+    def _rpc(self, upload, part, chunk):
+        if upload.big:
+            return raw.functions.upload.SaveBigFilePart(
+                file_id=upload.file_id, file_part=part, file_total_parts=upload.total, bytes=chunk
+            )
+        return raw.functions.upload.SaveFilePart(file_id=upload.file_id, file_part=part, bytes=chunk)
+
+    async def _send_part(self, upload, part, chunk):
+        for attempt in range(self.part_retries + 1):
+            try:
+                async with self._slots:
+                    session = await self._session()
+                    if await session.invoke(self._rpc(upload, part, chunk)):
+                        upload.done.add(part)
+                        return
+                error = "server did not confirm the part"
+            except RETRYABLE as e:
+                error = e
+            if attempt < self.part_retries:
+                self.retries += 1
+                logger.warning(f"Upload part {part}/{upload.total} failed ({error}), retry {attempt + 1}")
+                await asyncio.sleep(error.value if isinstance(error, FloodWait) else min(2 ** attempt, 30))
+        raise UploadError(f"part {part} of {upload.total} failed after {self.part_retries + 1} attempts: {error}")
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        """
+        То же, что Client.save_file для пути к файлу: возвращает InputFile/InputFileBig.
+        С `file_id` догружает одну часть `file_part` (ответ FILE_PART_MISSING) и возвращает None.
+        """
+        size = os.path.getsize(path)
+        if size == 0:
+            raise ValueError("File size equals to 0 B")
+        upload = self._state(path, size)
+        if file_id is not None:
+            # the part the server reported missing, under the id the message was sent with
+            upload.file_id = file_id
+            upload.done.discard(file_part)
+            missing = [file_part]
+        else:
+            missing = [part for part in range(upload.total) if part not in upload.done]
+
+        async def report():
+            if progress is None:
+                return
+            done = min(len(upload.done) * PART_SIZE, size)
+            if inspect.iscoroutinefunction(progress):
+                await progress(done, size, *progress_args)
+            else:
+                await self.client.loop.run_in_executor(self.client.executor, progress, done, size, *progress_args)
+
+        parts = iter(missing)
+        with open(path, 'rb') as fp:
+            async def worker():
+                for part in parts:
+                    fp.seek(part * PART_SIZE)
+                    chunk = fp.read(PART_SIZE)
+                    await self._send_part(upload, part, chunk)
+                    if file_id is None:
+                        await report()
+
+            await report()
+            workers = [
+                asyncio.create_task(worker())
+                for _ in range(min(len(missing), self.connections * PARTS_PER_CONNECTION))
+            ]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+        if file_id is not None:
+            return None
+        name = os.path.basename(path)
+        if upload.big:
+            return raw.types.InputFileBig(id=upload.file_id, parts=upload.total, name=name)
+        if upload.md5 is None:
+            upload.md5 = await asyncio.get_running_loop().run_in_executor(None, _md5, path)
+        return raw.types.InputFile(id=upload.file_id, parts=upload.total, name=name, md5_checksum=upload.md5)
+
+    async def close(self):
+        async with self._sessions_lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            try:
+                await session.stop()
+            except Exception as e:
+                logger.warning(f"Cannot stop upload session: {e}")
+
+
+class UploadClient(Client):
+    """
+    Client, который отправляет файлы с диска через Uploader (параллельные части,
+    повтор частей, продолжение), а не через встроенный save_file с одним
+    соединением. Файловые объекты по-прежнему грузит pyrogram.
+    """
+
+    def __init__(self, *args, upload_connections=4, part_retries=5, resume_ttl=3600, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.uploader = Uploader(self, upload_connections, part_retries, resume_ttl)
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        if not isinstance(path, (str, PurePath)):
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+        return await self.uploader.save_file(str(path), file_id, file_part, progress, progress_args)
+
+    async def stop(self, block=True):
+        await self.uploader.close()
+        return await super().stop(block)
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def iter_users(log_path, legacy_path=None):
+    """
+    Потоково перебрать id пользователей из журнала (по одному id на строку).
+    Если журнала ещё нет, читается старый users.json.
+    """
+    if os.path.isfile(log_path):
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield int(line)
+    elif legacy_path and os.path.isfile(legacy_path):
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+
+
+class UserRegistry:
+    """
+    Реестр пользователей в памяти с дозаписью новых id в журнал.
+
+    Проверка «уже известен» — поиск в set, а на диск новые id уходят пачками:
+    по таймеру `flush_interval` или при накоплении `batch_size` штук.
+    Старый users.json один раз переносится в журнал.
+    """
+
+    def __init__(self, log_path, legacy_path=None, flush_interval=5.0, batch_size=100):
+        self.log_path = log_path
+        self.flush_interval = float(flush_interval)
+        self.batch_size = int(batch_size)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flusher = None
+        if legacy_path and os.path.isfile(legacy_path) and not os.path.isfile(log_path):
+            self._migrate(legacy_path)
+        self._users = set(iter_users(log_path))
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def _migrate(self, legacy_path):
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+        self._write_all(dict.fromkeys(legacy))
+        os.replace(legacy_path, legacy_path + '.migrated')
+        logger.info(f"Migrated {len(legacy)} users from {legacy_path}")
+
+    def _write_all(self, user_ids):
+        tmp = self.log_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(f"{uid}\n" for uid in user_ids)
+        os.replace(tmp, self.log_path)
+
+    def add(self, user_id):
+        if user_id in self._users:
+            return
+        with self._lock:
+            self._users.add(user_id)
+            self._pending.append(user_id)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and not self._flusher.done():
+            return
+        try:
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_later())
+        except RuntimeError:
+            # no event loop (scripts): write through
+            self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        """Дописать накопленные id в журнал."""
+        with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.writelines(f"{uid}\n" for uid in batch)
+
+    def remove(self, user_ids):
+        """Удалить пользователей (например, заблокировавших бота) и переписать журнал."""
+        drop = set(user_ids)
+        if not drop:
+            return
+        self.flush()
+        with self._lock:
+            self._users -= drop
+            self._write_all(uid for uid in iter_users(self.log_path) if uid not in drop)
@@ -0,0 +1,144 @@
+import os
+import re
+import sys
+import signal
+import socket
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import main
+from jobqueue import JobQueue
+from uploader import UploadClient
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteStatus:
+    """
+    Статус-сообщение, которым владеет фронтенд. Правки не отправляются в Telegram,
+    а записываются в очередь как прогресс задачи; фронтенд показывает их сам.
+    """
+
+    def __init__(self, queue, qjob, worker):
+        self.chat = SimpleNamespace(id=qjob.payload['chat_id'])
+        self.id = qjob.payload['status_id']
+        self._queue = queue
+        self._job_id = qjob.id
+        self._worker = worker
+
+    async def edit_text(self, text):
+        self._queue.heartbeat(self._job_id, self._worker, progress=text)
+
+    async def delete(self):
+        # the front end deletes the status once the job is done
+        pass
+
+
+async def run_job(client, queue, qjob, worker):
+    """Выполнить задачу фронтенда; возвращает результат для JobQueue.complete()."""
+    p = qjob.payload
+    cq = await main.restore_callback(client, p)
+    sess = p['session']
+
+    if qjob.kind == 'batch':
+        await main.run_batch(cq, sess, p['key'])
+        return None
+
+    kind, variant = main.delivery_variant(p['data'], sess.get('type'))
+    job = main.metrics.job(kind, variant=variant, media=p['media_id'], user=p['user_id'], worker=worker)
+    status = RemoteStatus(queue, qjob, worker)
+    try:
+        delivered = await main.deliver(cq, sess, status, job, p.get('formats'))
+    except Exception as e:
+        job.finish('error', error=str(e))
+        raise
+    finally:
+        main.progress.discard(status)
+    job.finish()
+    return {'delivered': main.get_msg_id(delivered) if delivered else None}
+
+
+async def keep_alive(queue, qjob, worker, task):
+    while True:
+        await asyncio.sleep(main.HEARTBEAT_INTERVAL)
+        if not queue.heartbeat(qjob.id, worker):
+            # recovered by the front end after a stall and maybe already running elsewhere
+            logger.warning(f"Job {qjob.id} was taken away from {worker}, cancelling")
+            task.cancel()
+            return
+
+
+async def execute(client, queue, qjob, worker):
+    logger.info(f"Worker {worker} took {qjob.kind} job {qjob.id} (attempt {qjob.attempts})")
+    task = asyncio.create_task(run_job(client, queue, qjob, worker))
+    beat = asyncio.create_task(keep_alive(queue, qjob, worker, task))
+    try:
+        result = await task
+    except asyncio.CancelledError:
+        # shutdown: hand the job back without spending an attempt (no-op if it was taken away)
+        task.cancel()
+        queue.release(qjob.id, worker)
+        raise
+    except Exception as e:
+        logger.error(f"Job {qjob.id} failed: {e}")
+        queue.fail(qjob.id, worker, e)
+    else:
+        queue.complete(qjob.id, worker, result)
+    finally:
+        beat.cancel()
+
+
+async def serve(client, worker):
+    queue = main.job_queue or JobQueue(main.QUEUE_DB)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: Ctrl+C still stops the worker, jobs are recovered by heartbeat timeout
+            pass
+
+    running = {}
+    await client.start()
+    logger.info(f"Worker {worker} started, up to {main.WORKER_JOBS} jobs")
+    asyncio.create_task(main.warm_ydl_pool())
+    try:
+        while not stop.is_set():
+            qjob = queue.claim(worker) if len(running) < main.WORKER_JOBS else None
+            if qjob is not None:
+                task = asyncio.create_task(execute(client, queue, qjob, worker))
+                running[qjob.id] = task
+                task.add_done_callback(lambda _, job_id=qjob.id: running.pop(job_id, None))
+                continue
+            try:
+                await asyncio.wait_for(stop.wait(), main.QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        tasks = list(running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.stop()
+        logger.info(f"Worker {worker} stopped")
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else f"{socket.gethostname()}-{os.getpid()}"
+    # workers share DOWNLOAD_DIR: each downloads into its own staging folder
+    main.media_cache.owner = 'worker-' + re.sub(r'[^\w.-]', '_', name)
+    # no_updates: button presses go to the front end (main.py), workers only send files
+    client = UploadClient(
+        f"ytbot-worker-{name}", api_id=main.API_ID, api_hash=main.API_HASH, bot_token=main.token,
+        no_updates=True, in_memory=True, upload_connections=main.UPLOAD_CONNECTIONS,
+        part_retries=main.UPLOAD_PART_RETRIES, resume_ttl=main.UPLOAD_RESUME_TTL
+    )
+    try:
+        client.run(serve(client, name))
+    finally:
+        main.users.flush()
+        if main._runner is not None:
+            main._runner.shutdown()
+        main.ydl_pool.close()
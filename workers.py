@@ -0,0 +1,177 @@
+import sys
+import asyncio
+import logging
+import multiprocessing
+import threading
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ydl_pool import YdlPool
+from bandwidth import throttle_hook
+
+logger = logging.getLogger(__name__)
+
+# Fields of a yt-dlp progress dict that are forwarded from worker processes
+_HOOK_KEYS = (
+    'status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+    'filename', 'speed', 'eta', 'elapsed', 'fragment_index', 'fragment_count',
+)
+
+# Set in each worker process by _init_worker
+_progress_queue = None
+_ydl_pool = None
+_bucket = None
+
+
+class WorkerError(Exception):
+    """Ошибка yt-dlp в процессе-воркере (исходное исключение может не пережить pickle)."""
+
+
+def _init_worker(queue, profiles, cookies, bucket):
+    global _progress_queue, _ydl_pool, _bucket
+    _progress_queue = queue
+    # one job at a time per process, so one instance per profile is enough
+    _ydl_pool = YdlPool(profiles, size=1, cookies=cookies)
+    _bucket = bucket
+
+
+def _started():
+    return True
+
+
+@contextmanager
+def _spawn_entry():
+    """
+    spawn выполняет в каждом новом процессе модуль __main__ родителя, то есть
+    main.py целиком: клиент Telegram, базы, кеш файлов со своей чисткой. На время
+    запуска процессов вместо него подставляется этот модуль — воркерам нужен только он.
+    Пул запускает процессы внутри submit(), поэтому каждый submit идёт под этим блоком.
+    """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def run_download(job_id, profile, opts, url):
+    """Выполняется в процессе-воркере: скачать `url`, отправляя прогресс в общую очередь."""
+    def hook(d):
+        _progress_queue.put((job_id, {k: d.get(k) for k in _HOOK_KEYS}))
+
+    opts = dict(opts)
+    opts['progress_hooks'] = [hook] if _bucket is None else [throttle_hook(_bucket), hook]
+    try:
+        with _ydl_pool.lease(profile, opts) as ydl:
+            return ydl.download([url])
+    except Exception as e:
+        raise WorkerError(str(e)) from None
+
+
+class DownloadRunner:
+    """
+    Запуск загрузок yt-dlp в потоках или в пуле процессов.
+
+    В режиме `thread` задачи идут в переданный пул потоков, хуки вызываются напрямую,
+    а YoutubeDL берутся из общего пула `ydl_pool`.
+    В режиме `process` каждая загрузка выполняется в отдельном переиспользуемом
+    процессе со своим пулом YoutubeDL тех же профилей, а события прогресса
+    возвращаются через очередь и раздаются хукам из фонового потока, поэтому
+    разбор фрагментов не делит GIL с event loop бота. Если процесс-воркер
+    умер, пул пересоздаётся, и следующие загрузки идут уже в новые процессы.
+
+    Если задан `bucket` (TokenBucket бюджета скачивания), загрузки тормозятся
+    throttle_hook; процессам-воркерам передаётся его копия в общей памяти.
+    """
+
+    def __init__(self, mode='thread', thread_executor=None, processes=4, ydl_pool=None, bucket=None):
+        self.mode = mode
+        self.thread_executor = thread_executor
+        self.ydl_pool = ydl_pool
+        self.bucket = bucket
+        self._hooks = {}
+        self._ids = itertools.count()
+        self.processes = processes
+        self._pool = None
+        self._queue = None
+        if mode == 'process':
+            self._ctx = multiprocessing.get_context('spawn')
+            self._queue = self._ctx.Queue()
+            if bucket is not None:
+                self.bucket = bucket.shared(self._ctx)
+            self._pool = self._start_pool()
+            threading.Thread(target=self._pump, name='progress-pump', daemon=True).start()
+        elif mode != 'thread':
+            raise ValueError(f"Unknown worker mode: {mode}")
+
+    def _start_pool(self):
+        pool = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=self._ctx,
+            initializer=_init_worker,
+            initargs=(self._queue, self.ydl_pool.profiles, self.ydl_pool.cookies, self.bucket)
+        )
+        # start every process now, while __main__ points at this module (see _spawn_entry)
+        with _spawn_entry():
+            for _ in range(self.processes):
+                pool.submit(_started)
+        return pool
+
+    def _pump(self):
+        for job_id, d in iter(self._queue.get, None):
+            for hook in self._hooks.get(job_id, ()):
+                try:
+                    hook(d)
+                except Exception as e:
+                    logger.error(f"Progress hook failed: {e}")
+
+    async def download(self, opts, url, hooks=(), profile='video'):
+        """Скачать `url` YoutubeDL профиля `profile` с опциями задачи `opts`; `hooks` получают события прогресса."""
+        loop = asyncio.get_running_loop()
+        if self.mode == 'thread':
+            if self.bucket is not None:
+                hooks = [throttle_hook(self.bucket), *hooks]
+            opts = dict(opts, progress_hooks=list(hooks))
+
+            def run():
+                with self.ydl_pool.lease(profile, opts) as ydl:
+                    return ydl.download([url])
+            return await loop.run_in_executor(self.thread_executor, run)
+
+        job_id = next(self._ids)
+        self._hooks[job_id] = list(hooks)
+        try:
+            try:
+                future = self._submit(run_download, job_id, profile, opts, url)
+            except BrokenProcessPool:
+                # broken before this job started: it can go to the new pool
+                self._restart(self._pool)
+                future = self._submit(run_download, job_id, profile, opts, url)
+            pool = self._pool
+            try:
+                return await asyncio.wrap_future(future)
+            except BrokenProcessPool:
+                self._restart(pool)
+                raise WorkerError("download worker process died") from None
+        finally:
+            self._hooks.pop(job_id, None)
+
+    def _submit(self, *args):
+        # a submit may start a process too (see _spawn_entry)
+        with _spawn_entry():
+            return self._pool.submit(*args)
+
+    def _restart(self, pool):
+        # a worker was killed (OOM, signal): the whole pool is unusable, later jobs get a new one
+        if self._pool is pool:
+            logger.error("Download worker process died, restarting the process pool")
+            pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = self._start_pool()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._queue.put(None)
@@ -0,0 +1,172 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Options bound to a profile: they are consumed when YoutubeDL is built (cookie jar, default headers)
+PROFILE_OPTS = ('cookiefile', 'cookiesfrombrowser', 'http_headers')
+# Hook options that YoutubeDL registers in __init__ instead of reading params later
+_HOOKS = {
+    'progress_hooks': 'add_progress_hook',
+    'postprocessor_hooks': 'add_postprocessor_hook',
+    'post_hooks': 'add_post_hook',
+}
+
+
+def _check_job_opts(opts):
+    for key in PROFILE_OPTS:
+        if key in opts:
+            raise ValueError(f"'{key}' belongs to the YoutubeDL profile, not to a job")
+
+
+class YdlPool:
+    """
+    Пул готовых экземпляров yt_dlp.YoutubeDL, сгруппированных по профилям опций.
+
+    Профиль — базовые опции, которые YoutubeDL разбирает при создании: куки
+    (для Яндекса — из браузера), заголовки. Экземпляр создаётся один раз вместе
+    с загруженными экстракторами и соединениями и переиспользуется: на время
+    lease() поверх базовых опций накладываются опции задачи (формат, шаблон
+    имени, постпроцессоры, хуки), после задачи состояние сбрасывается.
+    Экземпляр, на котором задача упала, закрывается и не возвращается в пул.
+
+    Профилям из `cookies` ({профиль: CookieStore}) вместо собственного разбора
+    куки подставляется общий jar хранилища, он перечитывается при изменении файла.
+
+    yt_dlp импортируется при создании первого экземпляра, а не при запуске бота.
+    """
+
+    def __init__(self, profiles, size=4, on_lease=None, cookies=None):
+        self.profiles = profiles
+        self.size = max(int(size), 1)
+        # on_lease(profile, seconds, reused) is called from the worker thread for each lease
+        self.on_lease = on_lease
+        self.cookies = cookies or {}
+        self._idle = {name: [] for name in profiles}
+        self._lock = threading.Lock()
+        self.built = 0
+        self.reused = 0
+        self.import_seconds = None
+
+    def _yt_dlp(self):
+        started = time.perf_counter()
+        import yt_dlp
+        if self.import_seconds is None:
+            self.import_seconds = time.perf_counter() - started
+        return yt_dlp
+
+    def _attach_cookies(self, profile, ydl):
+        store = self.cookies.get(profile)
+        if store is not None:
+            # YoutubeDL.cookiejar is a cached_property: set before the first request, it is never loaded
+            ydl.__dict__['cookiejar'] = store.jar()
+        return ydl
+
+    def _build(self, profile):
+        ydl = self._attach_cookies(profile, self._yt_dlp().YoutubeDL(dict(self.profiles[profile])))
+        self.built += 1
+        # params normalized by __init__ are the clean state every lease starts from
+        return ydl, dict(ydl.params)
+
+    def _take(self, profile):
+        with self._lock:
+            idle = self._idle[profile]
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+        return self._build(profile), False
+
+    def _put(self, profile, entry):
+        with self._lock:
+            idle = self._idle[profile]
+            if len(idle) < self.size:
+                idle.append(entry)
+                return
+        entry[0].close()
+
+    @staticmethod
+    def _configure(ydl, base, opts):
+        _check_job_opts(opts)
+        # the same derived state YoutubeDL.__init__ builds from params
+        ydl.params = dict(base, **opts)
+        ydl._parse_outtmpl()
+        fmt = ydl.params.get('format')
+        ydl.format_selector = fmt if fmt in (None, '-') or callable(fmt) else ydl.build_format_selector(fmt)
+        for opt, add in _HOOKS.items():
+            for hook in ydl.params.get(opt) or ():
+                getattr(ydl, add)(hook)
+        if ydl.params.get('postprocessors'):
+            from yt_dlp.postprocessor import get_postprocessor
+            for pp_def in ydl.params['postprocessors']:
+                pp_def = dict(pp_def)
+                when = pp_def.pop('when', 'post_process')
+                ydl.add_post_processor(get_postprocessor(pp_def.pop('key'))(ydl, **pp_def), when=when)
+
+    @staticmethod
+    def _reset(ydl, base):
+        ydl.params = base
+        ydl._progress_hooks = []
+        ydl._postprocessor_hooks = []
+        ydl._post_hooks = []
+        ydl._pps = {when: [] for when in ydl._pps}
+        ydl._download_retcode = 0
+        ydl._num_downloads = 0
+        ydl._num_videos = 0
+        ydl._playlist_level = 0
+        ydl._playlist_urls = set()
+
+    @contextmanager
+    def lease(self, profile, opts=None):
+        """Экземпляр профиля `profile` с опциями задачи `opts` на время блока."""
+        started = time.perf_counter()
+        (ydl, base), reused = self._take(profile)
+        store = self.cookies.get(profile)
+        try:
+            if store is not None:
+                store.refresh()
+            self._configure(ydl, base, opts or {})
+        except BaseException:
+            ydl.close()
+            raise
+        if self.on_lease:
+            self.on_lease(profile, time.perf_counter() - started, reused)
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        self._reset(ydl, base)
+        self._put(profile, (ydl, base))
+
+    def create(self, profile, opts=None):
+        """Отдельный экземпляр вне пула — для вызывающих, которые держат его дольше одной задачи."""
+        _check_job_opts(opts or {})
+        return self._attach_cookies(profile, self._yt_dlp().YoutubeDL(dict(self.profiles[profile], **(opts or {}))))
+
+    def warm(self):
+        """Импортировать yt_dlp и создать по экземпляру каждого профиля заранее (вызывается в фоне)."""
+        started = time.perf_counter()
+        for profile in self.profiles:
+            with self._lock:
+                if self._idle[profile]:
+                    continue
+            try:
+                self._put(profile, self._build(profile))
+            except Exception as e:
+                # e.g. no browser cookies on this machine: the first real job will report it
+                logger.warning(f"Cannot prebuild YoutubeDL profile {profile}: {e}")
+        return time.perf_counter() - started
+
+    def idle(self):
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def close(self):
+        with self._lock:
+            entries = [entry for idle in self._idle.values() for entry in idle]
+            for idle in self._idle.values():
+                idle.clear()
+        for ydl, _ in entries:
+            ydl.close()